@@ -1,11 +1,15 @@
+from .cache import get_permission_cache
+
 MAX_AGE_OF_SIGNATURE_IN_SECONDS = 60
 SESSION_USER_KEY = "_cloak"
 SESSION_REDIRECT_KEY = "_cloak_redirect"
+# the session key the cloak session was registered under (see cloak.registry)
+SESSION_REGISTRY_KEY = "_cloak_registered_key"
+# the attribute can_cloak_as memoizes its decisions in, on the `user` object.
+# Since a user object normally only lives for one request, so does the memo
+PERMISSIONS_ATTRIBUTE = "_cloak_permissions"
 
-def can_cloak_as(user, other_user):
-    """
-    Returns true if `user` can cloak as `other_user`
-    """
+def _can_cloak_as(user, other_user):
     # check to see if the user is allowed to do this
     can_cloak = False
     try:
@@ -17,3 +21,91 @@ def can_cloak_as(user, other_user):
             pass
 
     return can_cloak
+
+def can_cloak_as(user, other_user):
+    """
+    Returns true if `user` can cloak as `other_user`
+
+    The decision is memoized on `user`, and if CLOAK_PERMISSION_CACHE_TTL is
+    set, it is cached across requests too
+    """
+    memo = getattr(user, PERMISSIONS_ATTRIBUTE, None)
+    if not isinstance(memo, dict):
+        memo = {}
+        setattr(user, PERMISSIONS_ATTRIBUTE, memo)
+    if other_user.pk in memo:
+        return memo[other_user.pk]
+
+    cache = None
+    if user.pk is not None and other_user.pk is not None:
+        cache = get_permission_cache()
+
+    can_cloak = None
+    if cache is not None:
+        can_cloak = cache.get(user, other_user)
+
+    if can_cloak is None:
+        can_cloak = bool(_can_cloak_as(user, other_user))
+        if cache is not None:
+            cache.set(user, other_user, can_cloak)
+
+    memo[other_user.pk] = can_cloak
+    return can_cloak
+
+def _can_cloak_as_many(user, other_users):
+    # let the user decide for all of them at once, if it can
+    try:
+        decide = user.can_cloak_as_many
+    except AttributeError:
+        return dict((other_user.pk, bool(_can_cloak_as(user, other_user))) for other_user in other_users)
+
+    allowed = set(decide(other_users))
+    return dict((other_user.pk, other_user.pk in allowed) for other_user in other_users)
+
+def can_cloak_as_many(user, other_users):
+    """
+    Returns the set of pks of the users in `other_users` (a queryset, or any
+    iterable of users) that `user` can cloak as
+
+    If `user` has a can_cloak_as_many(other_users) method, it decides for all
+    of them at once, and returns the pks of the ones it allows. Otherwise each
+    one is decided like can_cloak_as does. Either way, the decisions are
+    memoized on `user`, and cached with CLOAK_PERMISSION_CACHE_TTL, like
+    can_cloak_as's
+    """
+    other_users = list(other_users)
+    memo = getattr(user, PERMISSIONS_ATTRIBUTE, None)
+    if not isinstance(memo, dict):
+        memo = {}
+        setattr(user, PERMISSIONS_ATTRIBUTE, memo)
+
+    undecided = [other_user for other_user in other_users if other_user.pk not in memo]
+    cache = None
+    if undecided and user.pk is not None:
+        cache = get_permission_cache()
+
+    if cache is not None:
+        memo.update(cache.get_many(user, [other_user for other_user in undecided if other_user.pk is not None]))
+        undecided = [other_user for other_user in undecided if other_user.pk not in memo]
+
+    if undecided:
+        decisions = _can_cloak_as_many(user, undecided)
+        memo.update(decisions)
+        if cache is not None:
+            cache.set_many(user, [(other_user, decisions[other_user.pk]) for other_user in undecided if other_user.pk is not None])
+
+    return set(other_user.pk for other_user in other_users if memo[other_user.pk])
+
+def invalidate_can_cloak_as(user=None):
+    """
+    Forgets the cached can_cloak_as decisions involving `user` (as either
+    side), or every decision if `user` is None. Call this when a user's roles
+    or permissions change
+    """
+    memo = getattr(user, PERMISSIONS_ATTRIBUTE, None)
+    if isinstance(memo, dict):
+        memo.clear()
+
+    cache = get_permission_cache()
+    if cache is not None:
+        cache.invalidate(user)
@@ -0,0 +1,37 @@
+from django.utils.html import format_html
+from django.urls import reverse
+
+from . import can_cloak_as_many
+
+
+class CloakAdminMixin(object):
+    """
+    Adds a "Cloak" button to the changelist of a user ModelAdmin, on the rows
+    of the users request.user can cloak as:
+
+        class UserAdmin(CloakAdminMixin, admin.ModelAdmin):
+            ...
+
+    The permissions for the whole page are checked at once, with
+    can_cloak_as_many
+    """
+    def get_list_display(self, request):
+        return tuple(super(CloakAdminMixin, self).get_list_display(request)) + ("cloak_button",)
+
+    def get_changelist_instance(self, request):
+        changelist = super(CloakAdminMixin, self).get_changelist_instance(request)
+        allowed = can_cloak_as_many(request.user, changelist.result_list)
+        for obj in changelist.result_list:
+            obj._cloak_allowed = obj.pk in allowed
+        return changelist
+
+    def cloak_button(self, obj):
+        if not getattr(obj, "_cloak_allowed", False):
+            return ""
+        # the changelist is already a form with a CSRF token, so the button
+        # just points it at the cloak view
+        return format_html(
+            '<button type="submit" class="button" formaction="{}" formmethod="post">Cloak</button>',
+            reverse("cloak", args=[obj.pk]),
+        )
+    cloak_button.short_description = "Cloak"
@@ -0,0 +1,19 @@
+from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+
+
+class CloakConfig(AppConfig):
+    name = "cloak"
+    default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from . import checks
+        from .cache import invalidate_user
+        from .users import mark_recently_saved
+
+        User = get_user_model()
+        post_save.connect(invalidate_user, sender=User, dispatch_uid="cloak.invalidate_user.post_save")
+        post_delete.connect(invalidate_user, sender=User, dispatch_uid="cloak.invalidate_user.post_delete")
+        post_save.connect(mark_recently_saved, sender=User, dispatch_uid="cloak.mark_recently_saved.post_save")
+        post_delete.connect(mark_recently_saved, sender=User, dispatch_uid="cloak.mark_recently_saved.post_delete")
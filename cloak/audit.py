@@ -0,0 +1,217 @@
+"""
+A buffered audit log of cloak sessions.
+
+With CLOAK_AUDIT_LOG = True, the cloak and uncloak views, and every request
+made while cloaked, are recorded as cloak.models.CloakEvent rows. Events are
+queued in memory and written with bulk_create, either by a background thread
+(the default), or by the request that fills up a batch or finds the last write
+CLOAK_AUDIT_FLUSH_INTERVAL seconds ago (with CLOAK_AUDIT_BACKGROUND = False).
+
+The queue holds at most CLOAK_AUDIT_QUEUE_SIZE events. When it's full, new
+events are dropped (and counted), or with CLOAK_AUDIT_FULL_POLICY = "block",
+the request waits up to CLOAK_AUDIT_BLOCK_TIMEOUT seconds for room.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 5
+QUEUE_SIZE = 10000
+BLOCK_TIMEOUT = 1
+
+
+class AuditRecorder(object):
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE, background=True, full_policy="drop", block_timeout=BLOCK_TIMEOUT):
+        if full_policy not in ("drop", "block"):
+            raise ValueError("full_policy must be 'drop' or 'block'")
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.background = background
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._last_warning = None
+        self.queue = queue.Queue(queue_size)
+        self._last_flush = time.monotonic()
+        self._thread = None
+        self._lock = threading.Lock()
+        # the events the background thread has taken off the queue, but not
+        # written yet
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def record(self, kind, actor, target, request=None, response=None):
+        """
+        Queues an event for `actor` cloaked as `target`
+        """
+        from .models import CloakEvent
+
+        event = CloakEvent(
+            kind=kind,
+            actor_pk=str(actor.pk),
+            target_pk=str(target.pk),
+            method=request.method if request is not None else "",
+            path=request.get_full_path() if request is not None else "",
+            status_code=response.status_code if response is not None else None,
+            created_at=timezone.now(),
+        )
+
+        try:
+            if self.full_policy == "block":
+                self.queue.put(event, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            # a full queue drops a lot of events, so only warn about it once
+            # per flush interval
+            now = time.monotonic()
+            if self._last_warning is None or now - self._last_warning >= self.flush_interval:
+                self._last_warning = now
+                logger.warning("The cloak audit log queue is full, %d events have been dropped so far", self.dropped)
+
+        if self.background:
+            self._start()
+        elif self.queue.qsize() >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out everything in the queue, and the batch the background
+        thread is working on
+        """
+        self._last_flush = time.monotonic()
+        self._write_pending()
+        while True:
+            batch = self._take(self.batch_size)
+            if not batch:
+                break
+            self.write(batch)
+
+    def write(self, batch):
+        from .models import CloakEvent
+
+        try:
+            CloakEvent.objects.bulk_create(batch)
+        except Exception:
+            logger.exception("Could not write %d cloak audit log events", len(batch))
+
+    def _take(self, count, timeout=None):
+        """
+        Takes up to `count` events off the queue, waiting up to `timeout`
+        seconds for the queue to fill up
+        """
+        batch = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(batch) < count:
+            try:
+                if deadline is None:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _start(self):
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cloak-audit-log")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            # wait for the first event, then give the batch flush_interval
+            # seconds to fill up. The batch is kept in self._pending, so
+            # flush() can write it if the process exits in the meantime
+            self._hold(self.queue.get())
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._pending) < self.batch_size:
+                try:
+                    self._hold(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._write_pending()
+            close_old_connections()
+
+    def _hold(self, event):
+        with self._pending_lock:
+            self._pending.append(event)
+
+    def _write_pending(self):
+        # a flush() waits for a write the background thread is in the middle
+        # of, so the process doesn't exit before it's done
+        with self._write_lock:
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            if batch:
+                self.write(batch)
+
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def get_audit_recorder():
+    """
+    Returns the AuditRecorder, or None if CLOAK_AUDIT_LOG is off
+    """
+    global _recorder
+    if _recorder is None:
+        if not getattr(settings, "CLOAK_AUDIT_LOG", False):
+            return None
+
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = AuditRecorder(
+                    batch_size=getattr(settings, "CLOAK_AUDIT_BATCH_SIZE", BATCH_SIZE),
+                    flush_interval=getattr(settings, "CLOAK_AUDIT_FLUSH_INTERVAL", FLUSH_INTERVAL),
+                    queue_size=getattr(settings, "CLOAK_AUDIT_QUEUE_SIZE", QUEUE_SIZE),
+                    background=getattr(settings, "CLOAK_AUDIT_BACKGROUND", True),
+                    full_policy=getattr(settings, "CLOAK_AUDIT_FULL_POLICY", "drop"),
+                    block_timeout=getattr(settings, "CLOAK_AUDIT_BLOCK_TIMEOUT", BLOCK_TIMEOUT),
+                )
+    return _recorder
+
+
+def record(kind, actor, target, request=None, response=None):
+    """
+    Records an event in the audit log, if it's on
+    """
+    recorder = get_audit_recorder()
+    if recorder is not None:
+        recorder.record(kind, actor, target, request, response)
+
+
+def flush():
+    """
+    Writes out the queued events. This is called when the process exits
+    """
+    if _recorder is not None:
+        _recorder.flush()
+
+
+def reset_audit_recorder(setting, **kwargs):
+    global _recorder
+    if setting.startswith("CLOAK_AUDIT_"):
+        _recorder = None
+
+
+atexit.register(flush)
+setting_changed.connect(reset_audit_recorder)
@@ -0,0 +1,337 @@
+"""
+Caching of the user objects the middleware cloaks as.
+
+The cache is off by default. Set CLOAK_USER_CACHE_SIZE to the number of users
+to keep (per process), or CLOAK_CACHE_ALIAS to the name of a cache in the
+CACHES setting to share cloaked users between processes. CLOAK_USER_CACHE_TTL
+is the number of seconds an entry is good for. Entries are dropped whenever the
+user is saved or deleted, but changes that bypass model signals (like
+QuerySet.update()) are only picked up when the entry expires.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+
+USER_CACHE_TTL = 300
+
+
+class LocalUserCache(object):
+    """
+    A thread safe, per process LRU cache of user objects keyed by pk. Callers
+    always get their own copy of the cached object, so setting attributes on
+    it (like is_cloaked) can't leak into other requests.
+
+    Every delete bumps a generation number. A user loaded after a lookup is
+    only stored if nothing was deleted since, so a user saved while it was
+    being loaded can't be stored stale
+    """
+    def __init__(self, size, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, pk):
+        """
+        Returns a copy of the cached user with this pk, or None
+        """
+        return self.lookup(pk)[0]
+
+    def lookup(self, pk):
+        """
+        Returns a (user, version) tuple, where user is a copy of the cached
+        user or None. Pass the version to set() when storing the user
+        """
+        key = str(pk)
+        with self._lock:
+            generation = self._generation
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None, generation
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.copy(entry[0]), generation
+
+    def set(self, pk, user, version=None):
+        key = str(pk)
+        entry = (copy.copy(user), time.time() + self.ttl)
+        with self._lock:
+            if version is not None and version != self._generation:
+                # a user was invalidated since the lookup, maybe this one
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, pk):
+        with self._lock:
+            self._entries.pop(str(pk), None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict with the hit and miss counts, and the number of cached
+        users, which is handy for sizing the cache
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class SharedUserCache(object):
+    """
+    Stores user objects in one of Django's caches, so every worker can use a
+    user another worker looked up.
+
+    Each user has a version number stored next to it, which is part of the
+    key the user object itself is stored under. Invalidating a user just bumps
+    its version, and the old entry is left to expire
+    """
+    key_prefix = "cloak.user"
+
+    def __init__(self, cache, ttl=USER_CACHE_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _version_key(self, pk):
+        return "%s.version.%s" % (self.key_prefix, pk)
+
+    def _get_version(self, pk):
+        version_key = self._version_key(pk)
+        version = self.cache.get(version_key)
+        if version is None:
+            # the version was never set, or evicted. Start from the current
+            # time so we can't run into an entry stored under an old version
+            self.cache.add(version_key, int(time.time() * 1000), timeout=None)
+            version = self.cache.get(version_key)
+        return version
+
+    def _key(self, pk, version):
+        return "%s.%s.%s" % (self.key_prefix, pk, version)
+
+    def get(self, pk):
+        """
+        Returns the cached user with this pk, or None
+        """
+        return self.lookup(pk)[0]
+
+    def lookup(self, pk):
+        """
+        Returns a (user, version) tuple, where user is the cached user or None.
+        Pass the version to set() when storing the user, so if the user is
+        saved in the meantime, it's stored under the old version, where no one
+        will find it
+        """
+        version = self._get_version(pk)
+        user = self.cache.get(self._key(pk, version))
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user, version
+
+    def set(self, pk, user, version=None):
+        if version is None:
+            version = self._get_version(pk)
+        self.cache.set(self._key(pk, version), user, timeout=self.ttl)
+
+    def delete(self, pk):
+        try:
+            self.cache.incr(self._version_key(pk))
+        except ValueError:
+            # there is no version, so nothing was cached
+            pass
+
+    def clear(self):
+        # entries are shared with other processes, so only reset the counters
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Returns a dict with this process's hit and miss counts. The size of a
+        shared cache isn't known, so it's None
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": None}
+
+
+_user_cache = None
+_user_cache_lock = threading.Lock()
+
+
+def get_user_cache():
+    """
+    Returns the user cache configured in the settings, or None if caching is
+    disabled
+    """
+    global _user_cache
+    if _user_cache is None:
+        alias = getattr(settings, "CLOAK_CACHE_ALIAS", None)
+        size = getattr(settings, "CLOAK_USER_CACHE_SIZE", 0)
+        if not alias and not size:
+            return None
+
+        ttl = getattr(settings, "CLOAK_USER_CACHE_TTL", USER_CACHE_TTL)
+        with _user_cache_lock:
+            if _user_cache is None:
+                if alias:
+                    _user_cache = SharedUserCache(caches[alias], ttl)
+                else:
+                    _user_cache = LocalUserCache(size, ttl)
+    return _user_cache
+
+
+class PermissionCache(object):
+    """
+    Remembers can_cloak_as decisions in one of Django's caches.
+
+    Decisions are keyed on the pks of both users, a version number for each
+    user, and a global generation number. Bumping a user's version forgets
+    every decision that user was part of, and bumping the generation forgets
+    them all
+    """
+    key_prefix = "cloak.perm"
+
+    def __init__(self, cache, ttl):
+        self.cache = cache
+        self.ttl = ttl
+
+    def _get_versions(self, keys):
+        """
+        Returns a dict of the version numbers under `keys`. Like
+        SharedUserCache._get_version, a missing version starts from the current
+        time, so an eviction can't bring back a decision cached under an old one
+        """
+        versions = self.cache.get_many(keys)
+        missing = [key for key in set(keys) if key not in versions]
+        if missing:
+            seed = self._seed()
+            for key in missing:
+                self.cache.add(key, seed, timeout=None)
+            added = self.cache.get_many(missing)
+            for key in missing:
+                versions[key] = added.get(key, seed)
+        return versions
+
+    def _keys(self, user, other_users):
+        """
+        Returns the key of the decision for each of `other_users`, fetching
+        all the version numbers they need at once
+        """
+        generation_key = "%s.generation" % self.key_prefix
+        version_keys = [generation_key] + ["%s.version.%s" % (self.key_prefix, pk) for pk in [user.pk] + [other_user.pk for other_user in other_users]]
+        versions = self._get_versions(version_keys)
+        return [
+            "%s.%s.%s.%s.%s.%s" % (
+                self.key_prefix,
+                versions[generation_key],
+                versions[version_keys[1]],
+                versions[version_keys[i + 2]],
+                user.pk,
+                other_user.pk,
+            )
+            for i, other_user in enumerate(other_users)
+        ]
+
+    def get(self, user, other_user):
+        """
+        Returns the cached decision, or None if there isn't one
+        """
+        return self.cache.get(self._keys(user, [other_user])[0])
+
+    def set(self, user, other_user, can_cloak):
+        self.cache.set(self._keys(user, [other_user])[0], can_cloak, timeout=self.ttl)
+
+    def get_many(self, user, other_users):
+        """
+        Returns a dict of the cached decisions for `other_users`, by pk. The
+        ones that aren't cached are left out
+        """
+        keys = self._keys(user, other_users)
+        decisions = self.cache.get_many(keys)
+        return dict((other_user.pk, decisions[key]) for other_user, key in zip(other_users, keys) if key in decisions)
+
+    def set_many(self, user, decisions):
+        """
+        Caches the decisions in `decisions`, a list of (other_user,
+        can_cloak) pairs
+        """
+        keys = self._keys(user, [other_user for other_user, can_cloak in decisions])
+        self.cache.set_many(dict((key, can_cloak) for key, (other_user, can_cloak) in zip(keys, decisions)), timeout=self.ttl)
+
+    def _seed(self):
+        # in microseconds, since a version can be evicted and seeded again
+        # within the millisecond it was first seeded in
+        return int(time.time() * 1000000)
+
+    def _bump(self, key):
+        # start from the current time if the key is missing so we can't end up
+        # back on a version we used before it was evicted
+        if not self.cache.add(key, self._seed(), timeout=None):
+            try:
+                self.cache.incr(key)
+            except ValueError:
+                pass
+
+    def invalidate(self, user=None):
+        if user is None:
+            self._bump("%s.generation" % self.key_prefix)
+        else:
+            self._bump("%s.version.%s" % (self.key_prefix, user.pk))
+
+
+def get_permission_cache():
+    """
+    Returns a PermissionCache if CLOAK_PERMISSION_CACHE_TTL is set, otherwise
+    None. The decisions are stored in the CLOAK_CACHE_ALIAS cache, or the
+    default cache
+    """
+    ttl = getattr(settings, "CLOAK_PERMISSION_CACHE_TTL", 0)
+    if not ttl:
+        return None
+    return PermissionCache(caches[getattr(settings, "CLOAK_CACHE_ALIAS", None) or "default"], ttl)
+
+
+def invalidate_user(sender, instance, **kwargs):
+    """
+    Signal receiver that drops `instance` from the user cache. It is connected
+    to the post_save and post_delete signals of the user model
+    """
+    cache = get_user_cache()
+    if cache is not None:
+        cache.delete(instance.pk)
+
+
+def reset_user_cache(setting, **kwargs):
+    """
+    Throw away the user cache when one of its settings changes (which really
+    only happens in tests)
+    """
+    global _user_cache
+    if setting.startswith("CLOAK_"):
+        _user_cache = None
+
+
+setting_changed.connect(reset_user_cache)
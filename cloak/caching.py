@@ -0,0 +1,120 @@
+"""
+Cache keys that know about cloaking.
+
+The middleware swaps request.user for the cloaked user, so a cache keyed on
+the user (or on the session cookie, which doesn't change when you cloak) would
+serve the actor's cached pages while they're cloaked, and the cloaked user's
+pages afterwards. These helpers put both users in the key instead:
+
+    cloak_cache_key(request)    a string for the (actor, cloaked user) pair
+    cloak_cache_page(timeout)   cache_page, with the pair in the key prefix
+    vary_on_cloak               vary_on_cookie, for the pair
+    {% cloakcache %}            the {% cache %} tag, varying on the pair
+
+vary_on_cloak adds the X-Cloak-Key header to the response's Vary header. The
+middleware replaces that request header (whatever the client sent) with the
+pair, lazily, so Django's cache middleware and cache_page key on it.
+"""
+import threading
+from functools import wraps
+
+from django.middleware.cache import CacheMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import decorator_from_middleware_with_args
+from django.utils.functional import lazy
+
+VARY_HEADER = "X-Cloak-Key"
+VARY_META_KEY = "HTTP_X_CLOAK_KEY"
+
+
+def get_user_cache_key(user):
+    """
+    Returns "anonymous", "user.<pk>", or "cloak.<actor pk>.<pk>" for a cloaked
+    user
+    """
+    if user is None or not user.is_authenticated:
+        return "anonymous"
+    if getattr(user, "is_cloaked", False):
+        return "cloak.%s.%s" % (user.cloak_actor.pk, user.pk)
+    return "user.%s" % user.pk
+
+
+def cloak_cache_key(request):
+    """
+    Returns a string that's different for each user, and for each pair of
+    actor and cloaked user. This resolves the cloak, if the middleware
+    hasn't yet
+    """
+    return get_user_cache_key(getattr(request, "user", None))
+
+
+def set_vary_header(request):
+    """
+    Puts the cloak_cache_key of `request` in its X-Cloak-Key header. It's only
+    worked out if a cache looks at it
+    """
+    request.META[VARY_META_KEY] = lazy(cloak_cache_key, str)(request)
+
+
+def vary_on_cloak(view):
+    """
+    Like django.views.decorators.vary.vary_on_cookie, but for each user, and
+    each actor and cloaked user pair
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        patch_vary_headers(response, ("Cookie", VARY_HEADER))
+        return response
+    return wrapper
+
+
+class CloakCacheMiddleware(CacheMiddleware):
+    """
+    CacheMiddleware, with the cloak_cache_key of each request in the key
+    prefix. The prefix is per request, so it's kept per thread while the
+    request is being handled, instead of on the (shared) middleware
+    """
+    def __init__(self, get_response=None, **kwargs):
+        self._local = threading.local()
+        super(CloakCacheMiddleware, self).__init__(get_response, **kwargs)
+
+    @property
+    def key_prefix(self):
+        return getattr(self._local, "key_prefix", self.base_key_prefix)
+
+    @key_prefix.setter
+    def key_prefix(self, value):
+        self.base_key_prefix = value
+
+    def get_key_prefix(self, request):
+        prefix = cloak_cache_key(request)
+        if self.base_key_prefix:
+            prefix = "%s.%s" % (self.base_key_prefix, prefix)
+        return prefix
+
+    def process_request(self, request):
+        self._local.key_prefix = self.get_key_prefix(request)
+        try:
+            return super(CloakCacheMiddleware, self).process_request(request)
+        finally:
+            del self._local.key_prefix
+
+    def process_response(self, request, response):
+        self._local.key_prefix = self.get_key_prefix(request)
+        try:
+            return super(CloakCacheMiddleware, self).process_response(request, response)
+        finally:
+            del self._local.key_prefix
+
+
+def cloak_cache_page(timeout, cache=None, key_prefix=None):
+    """
+    Like django.views.decorators.cache.cache_page, but each user, and each
+    actor and cloaked user pair, gets their own cached pages
+    """
+    return decorator_from_middleware_with_args(CloakCacheMiddleware)(
+        page_timeout=timeout,
+        cache_alias=cache,
+        key_prefix=key_prefix,
+    )
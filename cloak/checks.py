@@ -0,0 +1,124 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import checks
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+
+from .nonces import NONCE_STORE, CacheNonceStore
+from .users import get_login_lookup_fields, get_search_fields
+
+
+def _is_indexed(model, field):
+    """
+    Returns True if the database can look up values of `field` with an index
+    """
+    if field.primary_key or field.unique or field.db_index:
+        return True
+
+    opts = model._meta
+    leading = set()
+    for index in opts.indexes:
+        if index.fields:
+            leading.add(index.fields[0].lstrip("-"))
+    for constraint in opts.constraints:
+        if isinstance(constraint, models.UniqueConstraint) and constraint.condition is None and constraint.fields:
+            leading.add(constraint.fields[0])
+    for fields in list(opts.unique_together) + list(getattr(opts, "index_together", ())):
+        leading.add(fields[0])
+    return field.name in leading or field.attname in leading
+
+
+def _check_fields(setting, names, error_id, warning_id, hint):
+    """
+    Checks that the fields named in a setting exist, and are indexed
+    """
+    errors = []
+    user_model = get_user_model()
+    for name in names:
+        if name == "pk":
+            continue
+
+        # a field can have a lookup, like "email__istartswith", but not a path
+        # through a relation, like "profile__name"
+        field_name, _, lookup = name.partition("__")
+        try:
+            field = user_model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or (lookup and field.get_lookup(lookup) is None):
+            errors.append(checks.Error(
+                "%s contains %r, which is not a field of %s, or a field and a lookup." % (setting, name, user_model._meta.label),
+                id=error_id,
+            ))
+            continue
+
+        if not _is_indexed(user_model, field):
+            errors.append(checks.Warning(
+                "%s contains %r, which is not indexed." % (setting, field_name),
+                hint=hint % {"table": user_model._meta.db_table, "setting": setting},
+                obj=field,
+                id=warning_id,
+            ))
+    return errors
+
+
+@checks.register()
+def check_login_lookup_fields(app_configs, **kwargs):
+    """
+    Every field in CLOAK_LOGIN_LOOKUP_FIELDS is part of the login command's
+    lookup query, so it should exist, and it should be indexed, or the query
+    turns into a scan of the user table.
+
+    Only a list the project sets is checked: the default one includes the
+    email field, which auth.User doesn't index, and the package shouldn't warn
+    about its own defaults
+    """
+    if getattr(settings, "CLOAK_LOGIN_LOOKUP_FIELDS", None) is None:
+        return []
+
+    return _check_fields(
+        "CLOAK_LOGIN_LOOKUP_FIELDS",
+        get_login_lookup_fields(get_user_model()),
+        "cloak.E001",
+        "cloak.W001",
+        "Looking up users by this field scans the %(table)s table. Add an index on it, or remove it from %(setting)s.",
+    )
+
+
+@checks.register()
+def check_search_fields(app_configs, **kwargs):
+    """
+    The search view matches the start of every field in CLOAK_SEARCH_FIELDS,
+    which only stays fast with an index. The default, the USERNAME_FIELD, is
+    always indexed
+    """
+    return _check_fields(
+        "CLOAK_SEARCH_FIELDS",
+        get_search_fields(get_user_model()),
+        "cloak.E002",
+        "cloak.W002",
+        "Searching this field scans the %(table)s table. Add an index on it, or remove it from %(setting)s.",
+    )
+
+
+@checks.register()
+def check_nonce_store(app_configs, **kwargs):
+    """
+    The default nonce store keeps used single use links in a cache. A local
+    memory cache is per process, so a used link works again on another
+    worker, and a dummy cache doesn't remember anything at all
+    """
+    if getattr(settings, "CLOAK_NONCE_STORE", NONCE_STORE) != NONCE_STORE:
+        return []
+
+    cache = CacheNonceStore().cache
+    if not isinstance(cache, (LocMemCache, DummyCache)):
+        return []
+
+    return [checks.Warning(
+        "Single use login links are remembered in a %s, which isn't shared between processes." % cache.__class__.__name__,
+        hint="Set CLOAK_CACHE_ALIAS (or the default cache) to a cache that is shared between your workers, like memcached or redis, or set CLOAK_NONCE_STORE.",
+        id="cloak.W003",
+    )]
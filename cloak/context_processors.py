@@ -0,0 +1,23 @@
+from django.utils.functional import SimpleLazyObject
+
+
+def get_cloak_context(user):
+    """
+    Returns a dict with the cloaked `user`, the real user behind the cloak
+    ("actor", None if `user` isn't cloaked), and the is_cloaked flag. Both
+    users were already loaded by the middleware, so this makes no queries
+    """
+    is_cloaked = getattr(user, "is_cloaked", False)
+    return {
+        "is_cloaked": is_cloaked,
+        "actor": user.cloak_actor if is_cloaked else None,
+        "user": user,
+    }
+
+
+def cloak(request):
+    """
+    Adds `cloak` to the context, with the keys of get_cloak_context, e.g.
+    {{ cloak.actor }}. The cloak is only resolved if the template uses it
+    """
+    return {"cloak": SimpleLazyObject(lambda: get_cloak_context(getattr(request, "user", None)))}
@@ -0,0 +1,148 @@
+"""
+Timing and outcome events for cloak operations.
+
+Every event is sent as the cloak.signals.cloak_timing signal, and passed on to
+the stats collector in the CLOAK_STATS_COLLECTOR setting (a dotted path to a
+BaseStatsCollector subclass), if there is one. With CLOAK_SERVER_TIMING set
+(it defaults to DEBUG), the middleware also adds a Server-Timing header to the
+response with the time each operation took.
+
+When nothing is listening, instrumenting an operation costs next to nothing.
+"""
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from .signals import cloak_timing
+
+# the attribute on the request the timings for the Server-Timing header are
+# collected in
+TIMINGS_ATTRIBUTE = "_cloak_timings"
+
+
+class BaseStatsCollector(object):
+    """
+    Adapter between cloak's events and a metrics library. Subclass it and
+    implement timing() and incr(), e.g. with a StatsD client or Prometheus
+    histograms and counters
+    """
+    def timing(self, name, duration, tags):
+        """
+        Record that the `name` operation took `duration` seconds. `tags` is a
+        dict with the outcome, and cache hit or miss
+        """
+        pass
+
+    def incr(self, name, tags):
+        """
+        Count one `name` event
+        """
+        pass
+
+    def event(self, name, duration, outcome, cache, queries):
+        tags = {"outcome": outcome}
+        if cache is not None:
+            tags["cache"] = cache
+        self.timing("cloak.%s" % name, duration, tags)
+        self.incr("cloak.%s" % name, tags)
+        if queries is not None:
+            self.timing("cloak.%s.queries" % name, queries, tags)
+
+
+_stats_collector = None
+
+
+def get_stats_collector():
+    global _stats_collector
+    if _stats_collector is None:
+        path = getattr(settings, "CLOAK_STATS_COLLECTOR", None)
+        if path is None:
+            return None
+        _stats_collector = import_string(path)()
+    return _stats_collector
+
+
+def reset_stats_collector(setting, **kwargs):
+    global _stats_collector
+    if setting == "CLOAK_STATS_COLLECTOR":
+        _stats_collector = None
+
+
+setting_changed.connect(reset_stats_collector)
+
+
+def use_server_timing():
+    return getattr(settings, "CLOAK_SERVER_TIMING", settings.DEBUG)
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def instrument(name, request=None, count_queries=True):
+    """
+    Times the code in the with block, and sends it as a cloak event. The
+    block can set the "outcome" and "cache" keys of the dict this yields.
+
+    Queries are only counted on the current thread, so async code should pass
+    count_queries=False
+    """
+    event = {"outcome": None, "cache": None}
+    collector = get_stats_collector()
+    server_timing = request is not None and use_server_timing()
+    if collector is None and not server_timing and not cloak_timing.has_listeners():
+        yield event
+        return
+
+    counter = QueryCounter() if count_queries else None
+    with ExitStack() as stack:
+        if counter is not None:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+
+        start = time.perf_counter()
+        yield event
+        duration = time.perf_counter() - start
+
+    queries = counter.count if counter is not None else None
+    cloak_timing.send(
+        sender=None,
+        name=name,
+        duration=duration,
+        outcome=event["outcome"],
+        cache=event["cache"],
+        queries=queries,
+        request=request,
+    )
+    if collector is not None:
+        collector.event(name, duration, event["outcome"], event["cache"], queries)
+    if server_timing:
+        timings = getattr(request, TIMINGS_ATTRIBUTE, None)
+        if timings is None:
+            timings = []
+            setattr(request, TIMINGS_ATTRIBUTE, timings)
+        timings.append((name, duration))
+
+
+def add_server_timing_header(request, response):
+    """
+    Adds the timings collected for this request to the Server-Timing header
+    """
+    timings = getattr(request, TIMINGS_ATTRIBUTE, None)
+    if not timings:
+        return
+
+    value = ", ".join("cloak-%s;dur=%.3f" % (name, duration * 1000) for name, duration in timings)
+    if response.has_header("Server-Timing"):
+        value = "%s, %s" % (response["Server-Timing"], value)
+    response["Server-Timing"] = value
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from ...registry import prune
+
+
+class Command(BaseCommand):
+    help = 'Remove the cloak sessions that have ended from the registry'
+
+    def handle(self, *args, **options):
+        """
+        Removes the entries in the registry (see CLOAK_SESSION_REGISTRY) of
+        the sessions that expired, or aren't cloaked anymore
+        """
+        count = prune()
+        self.stdout.write("Removed %d stale cloak session%s" % (count, "" if count == 1 else "s"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...registry import revoke
+
+
+class Command(BaseCommand):
+    help = 'End the cloak sessions of a user, or as a user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--actor', help="The pk of the user whose cloak sessions should end")
+        parser.add_argument('--target', help="The pk of the user no one should be cloaked as anymore")
+
+    def handle(self, *args, **options):
+        """
+        Uncloaks the sessions in the registry (see CLOAK_SESSION_REGISTRY) of
+        the --actor, or that are cloaked as the --target
+        """
+        if options['actor'] is None and options['target'] is None:
+            raise CommandError("Pass --actor, --target, or both")
+
+        count = revoke(actor=options['actor'], target=options['target'])
+        self.stdout.write("Revoked %d cloak session%s" % (count, "" if count == 1 else "s"))
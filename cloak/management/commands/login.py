@@ -1,22 +1,31 @@
-from __future__ import print_function
+import csv
+import json
+import sys
+from itertools import chain, islice
 from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth import get_user_model
-from django.core.signing import TimestampSigner
-try:
-    from django.core.urlresolvers import reverse
-except ImportError:
-    from django.urls import reverse
-from django.core.exceptions import FieldError
+from django.urls import reverse
+from django.core.exceptions import FieldError, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import validate_email
+from django.db.models import Q
+from ...tokens import make_login_signature
+from ...users import get_login_lookup_fields
 from ...views import login
 
+BATCH_SIZE = 500
+
 class Command(BaseCommand):
-    args = '[USERNAME_FIELD value]'
+    args = '[USERNAME_FIELD value ...]'
     help = 'Login as a user using a temporary URL'
 
     def add_arguments(self, parser):
         # Positional arguments
-        parser.add_argument('identifier', nargs='?')
+        parser.add_argument('identifier', nargs='*', default=[])
+        parser.add_argument('--file', help="Read identifiers from this file, one per line (use - for stdin)")
+        parser.add_argument('--format', choices=["path", "csv", "json"], default="path", help="Output just the paths, CSV or JSON lines")
+        parser.add_argument('--single-use', action='store_true', help="Generate links that only work once")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Number of identifiers to look up per query")
 
     def handle(self, *args, **options):
         """
@@ -24,17 +33,21 @@ class Command(BaseCommand):
         is_superuser or is_staff flag set to true, or just the first user in
         the system period.
 
-        With a single argument, look for the user with that value as the
-        USERNAME_FIELD value.
+        With arguments (or a --file), look for the users with those values in
+        one of the CLOAK_LOGIN_LOOKUP_FIELDS (the pk, email or USERNAME_FIELD
+        by default). The lookups are done in batches, so generating thousands
+        of links only takes a few queries.
 
         When a user is found, print out a URL slug you can paste into your
         browser to login as the user.
         """
         user_model = get_user_model()
 
-        identifier = options['identifier']
+        identifiers = self.get_identifiers(options)
+        writer = self.get_writer(options['format'])
+        single_use = options['single_use']
 
-        if not identifier:
+        if identifiers is None:
             # find the first superuser, or staff member or user
             filters = [{"is_superuser": True}, {"is_staff": True}, {}]
             user = None
@@ -48,23 +61,127 @@ class Command(BaseCommand):
 
             if user is None:
                 raise CommandError("No users found!")
-        else:
-            # find the user with the email field or USERNAME_FIELD equal to the command line
-            # argument
-            try:
-                user = user_model._default_manager.filter(pk=identifier).first()
-            except:
-                user = None
-
-            if not user:
-                user = user_model._default_manager.filter(email=identifier).order_by("-is_active").first()
-                if not user:
-                    try:
-                        user = user_model._default_manager.get_by_natural_key(identifier)
-                    except user_model.DoesNotExist as e:
-                        raise CommandError("The user does not exist")
-
-        signer = TimestampSigner()
-        signature = signer.sign(str(user.pk))
-
-        self.stdout.write(reverse(login, args=(signature,)))
+
+            writer(None, user, reverse(login, args=(make_login_signature(user, single_use),)))
+            return
+
+        missing = 0
+        for batch in self.batches(identifiers, options['batch_size']):
+            users = self.find_users(user_model, batch)
+            for identifier in batch:
+                user = users.get(identifier)
+                if user is None:
+                    missing += 1
+                    self.stderr.write("The user %r does not exist" % identifier)
+                    continue
+
+                writer(identifier, user, reverse(login, args=(make_login_signature(user, single_use),)))
+
+        if missing == 1:
+            raise CommandError("The user does not exist")
+        elif missing:
+            raise CommandError("%d users do not exist" % missing)
+
+    def get_identifiers(self, options):
+        """
+        Returns an iterable of the identifiers passed on the command line or in
+        the --file, or None if there aren't any
+        """
+        identifiers = options['identifier'] or []
+        # call_command() can pass a single identifier as a string
+        if not isinstance(identifiers, (list, tuple)):
+            identifiers = [identifiers]
+
+        if options.get('file'):
+            return chain(identifiers, _read_identifiers(self.open_file(options['file'])))
+
+        return identifiers or None
+
+    def open_file(self, path):
+        """
+        Opens the --file, or returns stdin if it is "-"
+        """
+        if path == "-":
+            return sys.stdin
+        try:
+            return open(path)
+        except (IOError, OSError) as e:
+            raise CommandError("Can't read %s: %s" % (path, e.strerror))
+
+    def get_writer(self, format):
+        """
+        Returns a function that writes out the login path for a user in the
+        requested format
+        """
+        if format == "csv":
+            writer = csv.writer(self.stdout, lineterminator="")
+            writer.writerow(["identifier", "pk", "path"])
+            return lambda identifier, user, path: writer.writerow([identifier, user.pk, path])
+        elif format == "json":
+            return lambda identifier, user, path: self.stdout.write(json.dumps({"identifier": identifier, "pk": user.pk, "path": path}, cls=DjangoJSONEncoder))
+        return lambda identifier, user, path: self.stdout.write(path)
+
+    def batches(self, identifiers, size):
+        identifiers = iter(identifiers)
+        while True:
+            batch = list(islice(identifiers, size))
+            if not batch:
+                break
+            yield batch
+
+    def find_users(self, user_model, identifiers):
+        """
+        Returns a dict mapping each identifier to the user it identifies.
+
+        The identifiers are looked up in all of the CLOAK_LOGIN_LOOKUP_FIELDS
+        at once, with a single query. When an identifier matches more than one
+        user, the first field in CLOAK_LOGIN_LOOKUP_FIELDS wins, then active
+        users, then the lowest pk
+        """
+        fields = [user_model._meta.pk if name == "pk" else user_model._meta.get_field(name) for name in get_login_lookup_fields(user_model)]
+
+        # maps a field's value to the identifiers that have that value, for
+        # each field
+        wanted = []
+        query = Q()
+        for field in fields:
+            values = {}
+            for identifier in identifiers:
+                try:
+                    values.setdefault(field.to_python(identifier), []).append(identifier)
+                except ValidationError:
+                    # this can't be a value of the field, like an email for an
+                    # integer pk
+                    pass
+            wanted.append(values)
+            if values:
+                query |= Q(**{field.attname + "__in": list(values)})
+
+        if not query:
+            return {}
+
+        candidates = sorted(
+            user_model._default_manager.filter(query),
+            key=lambda user: (not getattr(user, "is_active", True), user.pk)
+        )
+
+        users = {}
+        for field, values in zip(fields, wanted):
+            for user in candidates:
+                for identifier in values.get(getattr(user, field.attname), ()):
+                    users.setdefault(identifier, user)
+        return users
+
+
+def _read_identifiers(lines):
+    """
+    Yields the non-blank lines of a file, and closes it (unless it's stdin)
+    """
+    try:
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
@@ -1,26 +1,251 @@
+import re
+from functools import partial
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.functional import SimpleLazyObject
 from . import SESSION_USER_KEY, can_cloak_as
-inherit_from = object
-try:
-    from django.utils.deprecation import MiddlewareMixin
-    inherit_from = MiddlewareMixin
-except ImportError:
-    pass
+from .audit import get_audit_recorder, record
+from .caching import set_vary_header
+from .instrumentation import instrument, add_server_timing_header
+from .tokens import use_signed_tokens, get_request_token, read_token, get_marker_cookie_name, delete_marker_cookie
+from .models import CloakEvent
+from .registry import use_registry, get_stale_key, rekey
+from .users import get_cloaked_user, aget_cloaked_user
 
-class CloakMiddleware(inherit_from):
+
+def may_be_cloaked(request):
     """
-    This middleware class checks to see if a cloak session variable is
-    set, and overrides the request.user object with the cloaked user
+    Returns False if the request is known not to be cloaked without loading
+    the session: with signed tokens, it has no token, and with the marker
+    cookie, it has no marker
     """
-    def process_request(self, request):
-        request.user.is_cloaked = False
-        if SESSION_USER_KEY in request.session:
+    if use_signed_tokens():
+        return bool(get_request_token(request))
+
+    marker = get_marker_cookie_name()
+    return marker is None or marker in request.COOKIES
+
+
+def get_cloak_pk(request, user):
+    """
+    Returns the pk of the user `user` is trying to cloak as, from the signed
+    token or the session, or None
+    """
+    if use_signed_tokens():
+        token = get_request_token(request)
+        return read_token(token, user) if token else None
+
+    # without the marker cookie, there is no need to look in the session
+    if not may_be_cloaked(request):
+        return None
+
+    marker = get_marker_cookie_name()
+    if SESSION_USER_KEY in request.session:
+        return request.session[SESSION_USER_KEY]
+    request._cloak_stale_marker = marker is not None
+    return None
+
+
+async def aget_cloak_pk(request, user):
+    """
+    Async version of get_cloak_pk
+    """
+    if use_signed_tokens():
+        token = get_request_token(request)
+        return read_token(token, user) if token else None
+
+    if not may_be_cloaked(request):
+        return None
+
+    marker = get_marker_cookie_name()
+    try:
+        pk = await request.session.aget(SESSION_USER_KEY)
+    except AttributeError:
+        pk = await sync_to_async(request.session.get)(SESSION_USER_KEY)
+    request._cloak_stale_marker = marker is not None and pk is None
+    return pk
+
+
+def get_user(request, user):
+    """
+    Returns the user `user` is cloaked as, or `user` itself if there is no
+    (permitted) cloak session. Either way, the returned object has the
+    is_cloaked flag set, and a cloaked user has the real user in its
+    cloak_actor attribute
+    """
+    # the authentication middleware's lazy user (and the session it comes
+    # from) is loaded first, so it isn't counted as part of resolving the cloak
+    getattr(user, "pk")
+
+    other_user = None
+    with instrument("resolve", request) as event:
+        event["outcome"] = "not-cloaked"
+        pk = get_cloak_pk(request, user)
+        if pk is not None:
             User = get_user_model()
             try:
-                user = User._default_manager.get(pk=request.session[SESSION_USER_KEY])
+                other_user = get_cloaked_user(pk, event)
+                event["outcome"] = "found"
             except User.DoesNotExist:
-                return None
+                event["outcome"] = "missing"
+
+    if other_user is not None:
+        with instrument("permission", request) as event:
+            allowed = can_cloak_as(user, other_user)
+            event["outcome"] = "allowed" if allowed else "denied"
+
+        if allowed:
+            other_user.is_cloaked = True
+            other_user.cloak_actor = user
+            return other_user
+
+    user.is_cloaked = False
+    return user
+
+
+async def aget_user(request, user, auser=None):
+    """
+    Async version of get_user. `auser` is the request.auser() coroutine
+    function of the authentication middleware, if there was one
+    """
+    if hasattr(request, "_acached_cloak_user"):
+        return request._acached_cloak_user
+
+    if auser is not None:
+        user = await auser()
+    else:
+        # evaluate the authentication middleware's lazy user outside of the
+        # event loop
+        await sync_to_async(getattr)(user, "pk")
+
+    result = user
+    other_user = None
+    with instrument("resolve", request, count_queries=False) as event:
+        event["outcome"] = "not-cloaked"
+        pk = await aget_cloak_pk(request, user)
+        if pk is not None:
+            User = get_user_model()
+            try:
+                other_user = await aget_cloaked_user(pk, event)
+                event["outcome"] = "found"
+            except User.DoesNotExist:
+                event["outcome"] = "missing"
+
+    if other_user is not None:
+        with instrument("permission", request, count_queries=False) as event:
+            allowed = await sync_to_async(can_cloak_as)(user, other_user)
+            event["outcome"] = "allowed" if allowed else "denied"
+
+        if allowed:
+            other_user.cloak_actor = user
+            result = other_user
+
+    result.is_cloaked = result is not user
+    request._acached_cloak_user = result
+    return result
+
+
+def compile_paths(prefixes, patterns):
+    """
+    Combines path prefixes and regexes into a single regex that matches the
+    start of a path, or returns None if there aren't any
+    """
+    alternatives = [re.escape(prefix) for prefix in prefixes or ()]
+    alternatives.extend("(?:%s)" % pattern for pattern in patterns or ())
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives))
+
+
+class CloakMiddleware(MiddlewareMixin):
+    """
+    This middleware class checks to see if a cloak session variable is
+    set, and overrides the request.user object with the cloaked user.
+
+    The check is deferred until request.user is actually used, so requests
+    that never look at the user don't pay for the session, the user lookup or
+    the permission check. Async code should use `await request.auser()`
+    instead, which does the check without blocking the event loop.
+
+    Requests for paths that start with one of the CLOAK_EXCLUDE_PATHS, or
+    match one of the CLOAK_EXCLUDE_PATTERNS regexes, are left alone entirely.
+    If CLOAK_INCLUDE_PATHS or CLOAK_INCLUDE_PATTERNS are set, only the
+    requests that match them are handled.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None):
+        self.include = compile_paths(getattr(settings, "CLOAK_INCLUDE_PATHS", None), getattr(settings, "CLOAK_INCLUDE_PATTERNS", None))
+        self.exclude = compile_paths(getattr(settings, "CLOAK_EXCLUDE_PATHS", None), getattr(settings, "CLOAK_EXCLUDE_PATTERNS", None))
+        super(CloakMiddleware, self).__init__(get_response)
+
+    def skip(self, request):
+        """
+        Returns True if the middleware shouldn't touch this request
+        """
+        if self.include is None and self.exclude is None:
+            return False
+
+        path = request.path_info
+        if self.include is not None and self.include.match(path) is None:
+            return True
+        return self.exclude is not None and self.exclude.match(path) is not None
+
+    def process_request(self, request):
+        set_vary_header(request)
+        if self.skip(request):
+            return None
+
+        user = request.user
+        request.user = SimpleLazyObject(lambda: get_user(request, user))
+        request.auser = partial(aget_user, request, user, getattr(request, "auser", None))
+
+    def process_response(self, request, response):
+        # with the audit log on, every cloaked request is recorded, so the
+        # cloak has to be resolved even if nothing else used request.user.
+        # Unless the marker cookie (or the lack of a token) says it isn't
+        # cloaked, which spares the session and the user
+        if get_audit_recorder() is not None and hasattr(request, "user") and not self.skip(request) and may_be_cloaked(request):
+            self.record_request(request, request.user, response)
+        self.delete_stale_marker(request, response)
+        self.update_registry(request)
+        add_server_timing_header(request, response)
+        return response
+
+    def update_registry(self, request):
+        # the session key changes on login and password changes, and the
+        # registry entry has to follow it, or the session can't be revoked
+        if use_registry():
+            old_key = get_stale_key(request)
+            if old_key is not None:
+                rekey(request, old_key)
+
+    def delete_stale_marker(self, request, response):
+        # the session isn't cloaked anymore (e.g. it was revoked), so there is
+        # no point in checking it again
+        if getattr(request, "_cloak_stale_marker", False):
+            delete_marker_cookie(response)
+
+    def record_request(self, request, user, response):
+        if getattr(user, "is_cloaked", False):
+            record(CloakEvent.REQUEST, user.cloak_actor, user, request, response)
 
-            if can_cloak_as(request.user, user):
-                request.user = user
-                request.user.is_cloaked = True
+    async def __acall__(self, request):
+        # process_request and process_response don't do any IO, so unlike
+        # MiddlewareMixin, there is no need to run them in a thread
+        response = self.process_request(request)
+        response = response or await self.get_response(request)
+        if get_audit_recorder() is not None and not self.skip(request) and may_be_cloaked(request):
+            # recording can write to the database, so it runs in a thread
+            await sync_to_async(self.record_request)(request, await request.auser(), response)
+        self.delete_stale_marker(request, response)
+        # the session is already loaded if it could have changed, so only
+        # moving the entry needs a thread
+        old_key = get_stale_key(request) if use_registry() else None
+        if old_key is not None:
+            await sync_to_async(rekey)(request, old_key)
+        add_server_timing_header(request, response)
+        return response
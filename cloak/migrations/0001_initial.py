@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloakEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('cloak', 'Cloak'), ('uncloak', 'Uncloak'), ('request', 'Request')], max_length=16)),
+                ('actor_pk', models.CharField(db_index=True, max_length=255)),
+                ('target_pk', models.CharField(db_index=True, max_length=255)),
+                ('method', models.CharField(blank=True, max_length=16)),
+                ('path', models.TextField(blank=True)),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'ordering': ['created_at', 'pk'],
+            },
+        ),
+    ]
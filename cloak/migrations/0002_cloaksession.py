@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloak', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CloakSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('actor_pk', models.CharField(db_index=True, max_length=255)),
+                ('target_pk', models.CharField(db_index=True, max_length=255)),
+                ('session_key', models.CharField(max_length=40, unique=True)),
+                ('started_at', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['started_at', 'pk'],
+            },
+        ),
+    ]
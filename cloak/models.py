@@ -1,3 +1,50 @@
 from django.db import models
 
-# Create your models here.
+
+class CloakEvent(models.Model):
+    """
+    An entry in the audit log of cloak sessions. These are written in batches
+    by cloak.audit.AuditRecorder when CLOAK_AUDIT_LOG is on.
+
+    The users are stored by pk (not foreign keys) so the log outlives them
+    """
+    CLOAK = "cloak"
+    UNCLOAK = "uncloak"
+    REQUEST = "request"
+    KINDS = (
+        (CLOAK, "Cloak"),
+        (UNCLOAK, "Uncloak"),
+        (REQUEST, "Request"),
+    )
+
+    kind = models.CharField(max_length=16, choices=KINDS)
+    actor_pk = models.CharField(max_length=255, db_index=True)
+    target_pk = models.CharField(max_length=255, db_index=True)
+    method = models.CharField(max_length=16, blank=True)
+    path = models.TextField(blank=True)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ["created_at", "pk"]
+
+    def __str__(self):
+        return "%s %s as %s %s" % (self.kind, self.actor_pk, self.target_pk, self.path)
+
+
+class CloakSession(models.Model):
+    """
+    A session that is cloaked right now. These are kept by the cloak and
+    uncloak views when CLOAK_SESSION_REGISTRY is on, so cloak.registry.revoke
+    can find the sessions to end without reading every session there is
+    """
+    actor_pk = models.CharField(max_length=255, db_index=True)
+    target_pk = models.CharField(max_length=255, db_index=True)
+    session_key = models.CharField(max_length=40, unique=True)
+    started_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ["started_at", "pk"]
+
+    def __str__(self):
+        return "%s as %s" % (self.actor_pk, self.target_pk)
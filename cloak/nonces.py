@@ -0,0 +1,43 @@
+"""
+Nonce stores remember which single use login links have been used.
+
+The store is set with CLOAK_NONCE_STORE (a dotted path to a BaseNonceStore
+subclass). The default stores nonces in the CLOAK_CACHE_ALIAS cache (or the
+default cache) until the link they belong to expires, so checking a nonce is a
+single cache operation, and the store cleans up after itself.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import get_random_string
+from django.utils.module_loading import import_string
+
+NONCE_STORE = "cloak.nonces.CacheNonceStore"
+
+
+def make_nonce():
+    return get_random_string(16)
+
+
+class BaseNonceStore(object):
+    def use(self, nonce, timeout):
+        """
+        Marks `nonce` as used for the next `timeout` seconds. Returns True if
+        it wasn't used already
+        """
+        raise NotImplementedError
+
+
+class CacheNonceStore(BaseNonceStore):
+    key_prefix = "cloak.nonce"
+
+    def __init__(self, alias=None):
+        self.cache = caches[alias or getattr(settings, "CLOAK_CACHE_ALIAS", None) or "default"]
+
+    def use(self, nonce, timeout):
+        # add() only sets the key if it isn't there, atomically on the cache
+        # backends that support it
+        return self.cache.add("%s.%s" % (self.key_prefix, nonce), True, timeout=timeout)
+
+
+def get_nonce_store():
+    return import_string(getattr(settings, "CLOAK_NONCE_STORE", NONCE_STORE))()
@@ -0,0 +1,149 @@
+"""
+Rate limiting and cheap sanity checks for the login view.
+
+Before the login view checks a signature, it makes sure the signature has the
+shape of one (CLOAK_LOGIN_MAX_SIGNATURE_LENGTH characters at most, ending in
+":<timestamp>:<signature>"), so junk is rejected without any crypto work.
+
+With CLOAK_LOGIN_RATE set, each client IP address gets a token bucket that
+refills at CLOAK_LOGIN_RATE requests per second, and holds up to
+CLOAK_LOGIN_BURST of them. The buckets are kept in memory, for the
+CLOAK_LOGIN_RATE_TABLE_SIZE most recently seen addresses. To share the limit
+between processes too, set CLOAK_LOGIN_RATE_CACHE to the name of a cache,
+which then counts requests in fixed windows (of CLOAK_LOGIN_BURST requests per
+CLOAK_LOGIN_BURST / CLOAK_LOGIN_RATE seconds).
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+
+MAX_SIGNATURE_LENGTH = 256
+LOGIN_BURST = 10
+RATE_TABLE_SIZE = 10000
+IP_HEADER = "REMOTE_ADDR"
+TRUSTED_PROXY_COUNT = 1
+
+# <value>:<base62 timestamp>:<urlsafe base64 signature>
+SIGNATURE_RE = re.compile(r"^[^\s]+:[0-9A-Za-z]+:[0-9A-Za-z_-]+$")
+
+
+def is_well_formed_signature(signature):
+    """
+    Returns True if `signature` looks like something make_login_signature
+    could have made. That doesn't mean it is valid
+    """
+    return len(signature) <= getattr(settings, "CLOAK_LOGIN_MAX_SIGNATURE_LENGTH", MAX_SIGNATURE_LENGTH) and SIGNATURE_RE.match(signature) is not None
+
+
+def get_client_ip(request):
+    """
+    Returns the IP address of the client, from the CLOAK_IP_HEADER key of
+    request.META. If that's a list (like X-Forwarded-For), the address
+    CLOAK_TRUSTED_PROXY_COUNT from the right is used: the one your outermost
+    proxy saw. Anything to the left of it was sent by the client, and can't be
+    trusted
+    """
+    value = request.META.get(getattr(settings, "CLOAK_IP_HEADER", IP_HEADER), "")
+    addresses = [address.strip() for address in value.split(",")]
+    count = getattr(settings, "CLOAK_TRUSTED_PROXY_COUNT", TRUSTED_PROXY_COUNT)
+    return addresses[max(0, len(addresses) - count)]
+
+
+class TokenBucketLimiter(object):
+    """
+    In memory token buckets, for the `size` most recently used keys
+    """
+    def __init__(self, rate, burst=LOGIN_BURST, size=RATE_TABLE_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """
+        Takes a token from the `key` bucket. Returns False if it was empty
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return allowed
+
+
+class CacheLimiter(object):
+    """
+    Counts requests per key in fixed windows of `window` seconds, in one of
+    Django's caches, and allows `limit` of them per window
+    """
+    key_prefix = "cloak.rate"
+
+    def __init__(self, cache, limit, window):
+        self.cache = cache
+        self.limit = limit
+        self.window = window
+
+    def allow(self, key):
+        key = "%s.%s.%d" % (self.key_prefix, key, time.time() // self.window)
+        if self.cache.add(key, 1, timeout=int(self.window) + 1):
+            return True
+        try:
+            return self.cache.incr(key) <= self.limit
+        except ValueError:
+            # the window expired between add() and incr()
+            return True
+
+
+_limiters = None
+_limiters_lock = threading.Lock()
+
+
+def get_login_limiters():
+    """
+    Returns the limiters a login request has to get past: the in memory one,
+    and the cache backed one if CLOAK_LOGIN_RATE_CACHE is set. The list is
+    empty when CLOAK_LOGIN_RATE isn't set
+    """
+    global _limiters
+    if _limiters is None:
+        rate = getattr(settings, "CLOAK_LOGIN_RATE", None)
+        if not rate:
+            return []
+
+        burst = getattr(settings, "CLOAK_LOGIN_BURST", LOGIN_BURST)
+        with _limiters_lock:
+            if _limiters is None:
+                limiters = [TokenBucketLimiter(rate, burst, getattr(settings, "CLOAK_LOGIN_RATE_TABLE_SIZE", RATE_TABLE_SIZE))]
+                alias = getattr(settings, "CLOAK_LOGIN_RATE_CACHE", None)
+                if alias:
+                    limiters.append(CacheLimiter(caches[alias], burst, burst / float(rate)))
+                _limiters = limiters
+    return _limiters
+
+
+def allow_login(request):
+    """
+    Returns False if the client has made too many login requests
+    """
+    key = get_client_ip(request)
+    return all(limiter.allow(key) for limiter in get_login_limiters())
+
+
+def reset_login_limiters(setting, **kwargs):
+    global _limiters
+    if setting.startswith("CLOAK_LOGIN_RATE") or setting == "CLOAK_LOGIN_BURST":
+        _limiters = None
+
+
+setting_changed.connect(reset_login_limiters)
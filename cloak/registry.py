@@ -0,0 +1,147 @@
+"""
+A registry of the sessions that are cloaked right now, so they can be revoked.
+
+With CLOAK_SESSION_REGISTRY = True, the cloak view records the actor, target
+and session key of each cloak session as a cloak.models.CloakSession, and the
+uncloak view removes it. revoke() then finds the sessions to end by actor or
+target with an indexed query, and only loads those sessions.
+
+The key a session was registered under is kept in the session too, so when
+the key changes (Django cycles it on login, and on a password change), the
+middleware moves the registry entry to the new key at the end of the request.
+Entries for sessions that aren't cloaked anymore (because they expired, or
+were logged out) are removed by revoke(), and by prune() (the
+cloak_clearsessions command).
+
+Cloaks carried in signed tokens (CLOAK_SIGNED_TOKEN) aren't in the session, so
+they aren't registered.
+"""
+from importlib import import_module
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import SESSION_USER_KEY, SESSION_REDIRECT_KEY, SESSION_REGISTRY_KEY
+
+
+def use_registry():
+    return getattr(settings, "CLOAK_SESSION_REGISTRY", False)
+
+
+def register(request, actor, target):
+    """
+    Records that the session of `request` is cloaking `actor` as `target`
+    """
+    from .models import CloakSession
+
+    # the session needs a key before it can be registered
+    if request.session.session_key is None:
+        request.session.save()
+
+    CloakSession.objects.update_or_create(
+        session_key=request.session.session_key,
+        defaults={"actor_pk": str(actor.pk), "target_pk": str(target.pk), "started_at": timezone.now()},
+    )
+    request.session[SESSION_REGISTRY_KEY] = request.session.session_key
+
+
+def unregister(request):
+    """
+    Forgets the cloak session of `request`, if there is one
+    """
+    from .models import CloakSession
+
+    key = request.session.pop(SESSION_REGISTRY_KEY, None) or request.session.session_key
+    if key is not None:
+        CloakSession.objects.filter(session_key=key).delete()
+
+
+def get_stale_key(request):
+    """
+    Returns the key the session of `request` was registered under, if it has
+    changed since. Sessions that weren't used in the request can't have
+    changed, so they aren't loaded
+    """
+    session = getattr(request, "session", None)
+    if session is None or not session.accessed:
+        return None
+
+    key = session.get(SESSION_REGISTRY_KEY)
+    if key is not None and key != session.session_key and session.session_key is not None:
+        return key
+    return None
+
+
+def rekey(request, old_key):
+    """
+    Moves the registry entry of the session of `request` from `old_key` to its
+    current key
+    """
+    from .models import CloakSession
+
+    CloakSession.objects.filter(session_key=old_key).update(session_key=request.session.session_key)
+    request.session[SESSION_REGISTRY_KEY] = request.session.session_key
+
+
+def _pk(user):
+    return str(getattr(user, "pk", user))
+
+
+def _load(cloak_session):
+    """
+    Returns the session of `cloak_session`, or None if it isn't cloaked as
+    its target anymore (it may have expired, been logged out, or been cloaked
+    as someone else since)
+    """
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    session = SessionStore(cloak_session.session_key)
+    if str(session.get(SESSION_USER_KEY)) != cloak_session.target_pk:
+        return None
+    return session
+
+
+def revoke(actor=None, target=None):
+    """
+    Ends every cloak session of `actor`, or as `target` (users or pks), or
+    both if they're both given. Returns the number of sessions that were
+    uncloaked
+    """
+    from .models import CloakSession
+
+    if actor is None and target is None:
+        raise ValueError("Pass an actor, a target, or both")
+
+    sessions = CloakSession.objects.all()
+    if actor is not None:
+        sessions = sessions.filter(actor_pk=_pk(actor))
+    if target is not None:
+        sessions = sessions.filter(target_pk=_pk(target))
+
+    revoked = 0
+    registered = list(sessions)
+    for cloak_session in registered:
+        session = _load(cloak_session)
+        if session is None:
+            continue
+
+        del session[SESSION_USER_KEY]
+        session.pop(SESSION_REDIRECT_KEY, None)
+        session.pop(SESSION_REGISTRY_KEY, None)
+        session.save()
+        revoked += 1
+
+    # the entries of the sessions that weren't cloaked anymore go too
+    CloakSession.objects.filter(pk__in=[cloak_session.pk for cloak_session in registered]).delete()
+    return revoked
+
+
+def prune():
+    """
+    Removes the registry entries of sessions that aren't cloaked as their
+    target anymore. Returns the number of entries removed
+    """
+    from .models import CloakSession
+
+    stale = [cloak_session.pk for cloak_session in CloakSession.objects.iterator() if _load(cloak_session) is None]
+    CloakSession.objects.filter(pk__in=stale).delete()
+    return len(stale)
@@ -0,0 +1,12 @@
+from django.dispatch import Signal
+
+# Sent after each instrumented cloak operation (see cloak.instrumentation),
+# with these arguments:
+#
+#   name: "resolve", "permission", "cloak", "uncloak" or "login"
+#   duration: how long it took, in seconds
+#   outcome: what happened, like "found" (resolve), or "denied" (permission)
+#   cache: "hit" or "miss" if a cache was used, otherwise None
+#   queries: how many queries were made, or None if they weren't counted
+#   request: the request, if there is one
+cloak_timing = Signal()
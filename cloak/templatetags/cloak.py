@@ -0,0 +1,86 @@
+from django import template
+from django.templatetags.cache import CacheNode
+
+from ..caching import get_user_cache_key
+from ..context_processors import get_cloak_context
+
+register = template.Library()
+
+
+def get_context_user(context):
+    """
+    Returns request.user, or the user in the context if there's no request.
+    Raises KeyError if there's neither
+    """
+    if "request" in context:
+        return getattr(context["request"], "user", None)
+    return context["user"]
+
+
+class CloakKey(object):
+    """
+    Stands in for a vary_on variable of the cache tag, and resolves to the
+    cache key of the user in the context
+    """
+    def resolve(self, context):
+        try:
+            user = get_context_user(context)
+        except KeyError:
+            raise template.TemplateSyntaxError("The 'cloakcache' tag needs the request or the user in the context")
+        return get_user_cache_key(user)
+
+
+class CloakCacheNode(CacheNode):
+    def __init__(self, nodelist, expire_time_var, fragment_name, vary_on, cache_name):
+        super(CloakCacheNode, self).__init__(nodelist, expire_time_var, fragment_name, list(vary_on) + [CloakKey()], cache_name)
+
+
+@register.tag("cloakcache")
+def do_cloakcache(parser, token):
+    """
+    Works just like the cache tag, but the fragment is cached separately for
+    each user, and for each actor and cloaked user pair. It needs the request
+    (or the user) in the context:
+
+        {% load cloak %}
+        {% cloakcache 500 sidebar [var1] [var2] .. [using="cachename"] %}
+            .. some expensive processing ..
+        {% endcloakcache %}
+    """
+    nodelist = parser.parse(("endcloakcache",))
+    parser.delete_first_token()
+    tokens = token.split_contents()
+    if len(tokens) < 3:
+        raise template.TemplateSyntaxError("'%r' tag requires at least 2 arguments." % tokens[0])
+    if len(tokens) > 3 and tokens[-1].startswith("using="):
+        cache_name = parser.compile_filter(tokens[-1][len("using="):])
+        tokens = tokens[:-1]
+    else:
+        cache_name = None
+    return CloakCacheNode(
+        nodelist,
+        parser.compile_filter(tokens[1]),
+        tokens[2],  # fragment_name can't be a variable
+        [parser.compile_filter(t) for t in tokens[3:]],
+        cache_name,
+    )
+
+
+@register.inclusion_tag("cloak/banner.html", takes_context=True)
+def cloak_banner(context):
+    """
+    Renders a "you are cloaked as" banner with an uncloak button, or nothing
+    if the user isn't cloaked. It uses the users the middleware already
+    loaded, from the cloak context processor, or the request (or `user`) in
+    the context:
+
+        {% load cloak %}
+        {% cloak_banner %}
+    """
+    if "cloak" in context:
+        return {"cloak": context["cloak"]}
+    try:
+        user = get_context_user(context)
+    except KeyError:
+        user = None
+    return {"cloak": get_cloak_context(user)}
@@ -1,22 +1,90 @@
-from __future__ import absolute_import
+import csv
+import json
+import os
 import tempfile
+import threading
+import time
+import uuid
 from mock import MagicMock, Mock, patch
 from model_mommy.mommy import make, prepare
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.conf.urls import include, url
+from django.utils.http import urlencode
+from django.test import Client, TestCase, override_settings
+from django.core.cache import cache, caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpRequest, HttpResponse
+from django.template import Context, Engine, RequestContext
+from django.utils.functional import SimpleLazyObject
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.core.signing import TimestampSigner, BadSignature, SignatureExpired
-try:
-    from django.core.urlresolvers import reverse
-except ImportError:
-    from django.urls import reverse
+from django.urls import reverse
 from django.contrib.auth import REDIRECT_FIELD_NAME
 
-from . import SESSION_USER_KEY, can_cloak_as, SESSION_REDIRECT_KEY
-from .middleware import CloakMiddleware
-from .views import login, uncloak
+from . import SESSION_USER_KEY, can_cloak_as, can_cloak_as_many, SESSION_REDIRECT_KEY, invalidate_can_cloak_as
+from .audit import AuditRecorder, get_audit_recorder
+from .context_processors import cloak as cloak_context_processor
+from .checks import check_login_lookup_fields, check_nonce_store, check_search_fields
+from .cache import LocalUserCache, PermissionCache, SharedUserCache, get_user_cache
+from .caching import CloakCacheMiddleware, cloak_cache_key, cloak_cache_page, vary_on_cloak
+from .instrumentation import BaseStatsCollector
+from .management.commands.login import Command as LoginCommand
+from .middleware import CloakMiddleware, aget_user, compile_paths, get_user
+from .models import CloakEvent, CloakSession
+from .ratelimit import CacheLimiter, TokenBucketLimiter, get_client_ip, is_well_formed_signature
+from .registry import prune, revoke
+from .signals import cloak_timing
+from .tokens import make_token, read_token, make_login_signature
+from .users import aget_read_queryset, get_cloaked_user, get_read_queryset, was_recently_saved
+from .views import login, uncloak, alogin, acloak, auncloak
+
+def user_queryset():
+    return get_user_model().objects.prefetch_related("groups")
+
+def whoami(request):
+    return HttpResponse("%s %s" % (request.user.pk, getattr(request.user, "is_cloaked", None)))
+
+def render_banner(context):
+    engine = Engine(dirs=[os.path.join(os.path.dirname(__file__), "templates")], libraries={"cloak": "cloak.templatetags.cloak"})
+    return engine.from_string("{% load cloak %}{% cloak_banner %}").render(Context(context))
+
+def banner(request):
+    # a view that only uses request.user through the context processor
+    engine = Engine(dirs=[os.path.join(os.path.dirname(__file__), "templates")], libraries={"cloak": "cloak.templatetags.cloak"})
+    template = engine.from_string("{% load cloak %}{% cloak_banner %}")
+    return HttpResponse(template.render(RequestContext(request, processors=[cloak_context_processor])))
+
+def ping(request):
+    # a view that doesn't use request.user
+    return HttpResponse("pong")
+
+@vary_on_cloak
+def cached_whoami(request):
+    return whoami(request)
+
+def cycle(request):
+    # what login() and update_session_auth_hash() do to the session
+    request.session.cycle_key()
+    return HttpResponse()
+
+# URLs for the async views, and a view that uses request.user
+urlpatterns = [
+    url(r'^cloak/', include('cloak.urls')),
+    url(r'^whoami$', whoami, name="whoami"),
+    url(r'^banner$', banner, name="banner"),
+    url(r'^cycle$', cycle, name="cycle"),
+    url(r'^ping$', ping, name="ping"),
+    url(r'^cached-whoami$', cached_whoami, name="cached-whoami"),
+    url(r'^login/(?P<signature>.*)$', alogin, name="alogin"),
+    url(r'^cloak/(?P<pk>.+)$', acloak, name="acloak"),
+    url(r'^uncloak$', auncloak, name="auncloak"),
+]
 
 class CloakMiddlewareTest(TestCase):
     def test_return_none_if_key_isnt_in_session(self):
@@ -29,7 +97,7 @@ class CloakMiddlewareTest(TestCase):
         request = MagicMock(user=user)
         self.assertEqual(None, cm.process_request(request))
         self.assertEqual(user, request.user)
-        self.assertFalse(user.is_cloaked)
+        self.assertFalse(request.user.is_cloaked)
 
     def test_user_does_not_exist_returns_None(self):
         """
@@ -38,10 +106,10 @@ class CloakMiddlewareTest(TestCase):
         """
         cm = CloakMiddleware()
         user = Mock()
-        request = Mock(session={SESSION_USER_KEY: '123'}, user=user)
+        request = Mock(session={SESSION_USER_KEY: '123'}, user=user, META={})
         self.assertEqual(None, cm.process_request(request))
         self.assertEqual(user, request.user)
-        self.assertFalse(user.is_cloaked)
+        self.assertFalse(request.user.is_cloaked)
 
     def test_request_user_is_replaced_when_cloaked(self):
         """
@@ -52,7 +120,7 @@ class CloakMiddlewareTest(TestCase):
         user = make(get_user_model())
         user_to_cloak_as = make(get_user_model())
         cm = CloakMiddleware()
-        request = Mock(session={SESSION_USER_KEY: user_to_cloak_as.pk}, user=user)
+        request = Mock(session={SESSION_USER_KEY: user_to_cloak_as.pk}, user=user, META={})
 
         with patch("cloak.middleware.can_cloak_as", return_value=True):
             self.assertEqual(None, cm.process_request(request))
@@ -67,12 +135,339 @@ class CloakMiddlewareTest(TestCase):
         user = make(get_user_model())
         user_to_cloak_as = make(get_user_model())
         cm = CloakMiddleware()
-        request = Mock(session={SESSION_USER_KEY: user_to_cloak_as.pk}, user=user)
+        request = Mock(session={SESSION_USER_KEY: user_to_cloak_as.pk}, user=user, META={})
 
         with patch("cloak.middleware.can_cloak_as", return_value=False):
             self.assertEqual(None, cm.process_request(request))
             self.assertEqual(request.user, user)
 
+    def test_cloak_is_resolved_lazily(self):
+        """
+        Nothing should be looked up until something actually reads
+        request.user
+        """
+        user = make(get_user_model())
+        user_to_cloak_as = make(get_user_model())
+        cm = CloakMiddleware()
+        session = MagicMock()
+        session.__contains__.return_value = True
+        session.__getitem__.return_value = user_to_cloak_as.pk
+        # a Mock request would evaluate the lazy object as soon as it is
+        # assigned to request.user
+        request = HttpRequest()
+        request.session = session
+        request.user = user
+
+        with patch("cloak.middleware.can_cloak_as", return_value=True) as mock:
+            with self.assertNumQueries(0):
+                self.assertEqual(None, cm.process_request(request))
+            self.assertFalse(session.__contains__.called)
+            self.assertFalse(mock.called)
+
+            with self.assertNumQueries(1):
+                self.assertTrue(request.user.is_cloaked)
+            mock.assert_called_once_with(user, user_to_cloak_as)
+
+    def test_no_queries_when_user_is_not_used(self):
+        """
+        A request that never looks at request.user shouldn't cost any queries,
+        even for a cloaked user
+        """
+        user = prepare(get_user_model())
+        user.set_password("foobar")
+        user.save()
+        self.client.login(username=user.username, password="foobar")
+        session = self.client.session
+        session[SESSION_USER_KEY] = make(get_user_model()).pk
+        session.save()
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/this-does-not-exist")
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(ROOT_URLCONF="cloak.tests")
+class PathBypassTest(TestCase):
+    def setUp(self):
+        self.user = make(get_user_model(), is_staff=True)
+        self.client.force_login(self.user)
+        session = self.client.session
+        session[SESSION_USER_KEY] = make(get_user_model()).pk
+        session.save()
+
+    def whoami(self):
+        # the middleware compiles its paths once, so each check needs a client
+        # with a fresh middleware chain
+        client = Client()
+        client.cookies = self.client.cookies
+        return client.get(reverse("whoami")).content.decode()
+
+    def test_exclude(self):
+        with self.settings(CLOAK_EXCLUDE_PATHS=["/static/", "/who"]):
+            # the user is left untouched
+            self.assertEqual("%s None" % self.user.pk, self.whoami())
+        with self.settings(CLOAK_EXCLUDE_PATTERNS=[r"/wh[aeiou]"]):
+            self.assertEqual("%s None" % self.user.pk, self.whoami())
+        with self.settings(CLOAK_EXCLUDE_PATHS=["/static/"], CLOAK_EXCLUDE_PATTERNS=[r"/x"]):
+            self.assertTrue(self.whoami().endswith(" True"))
+
+    def test_include(self):
+        with self.settings(CLOAK_INCLUDE_PATHS=["/admin/"]):
+            self.assertEqual("%s None" % self.user.pk, self.whoami())
+        with self.settings(CLOAK_INCLUDE_PATTERNS=[r"/who"]):
+            self.assertTrue(self.whoami().endswith(" True"))
+        with self.settings(CLOAK_INCLUDE_PATTERNS=[r"/who"], CLOAK_EXCLUDE_PATHS=["/whoami"]):
+            self.assertEqual("%s None" % self.user.pk, self.whoami())
+
+    def test_compile_paths(self):
+        self.assertEqual(None, compile_paths([], None))
+        regex = compile_paths(["/static/", "/a.b"], [r"/hooks/\d+/$"])
+        self.assertTrue(regex.match("/static/foo.css"))
+        self.assertTrue(regex.match("/a.b"))
+        self.assertFalse(regex.match("/axb"))
+        self.assertFalse(regex.match("/foo/static/"))
+        self.assertTrue(regex.match("/hooks/12/"))
+        self.assertFalse(regex.match("/hooks/x/"))
+
+
+@override_settings(ROOT_URLCONF="cloak.tests", CLOAK_MARKER_COOKIE="cloaked")
+class MarkerCookieTest(TestCase):
+    def setUp(self):
+        self.user = make(get_user_model(), is_staff=True)
+        self.other_user = make(get_user_model())
+        self.client.force_login(self.user)
+
+    def test_session_is_skipped_without_the_marker(self):
+        request = HttpRequest()
+        request.session = MagicMock()
+        user = get_user(request, self.user)
+        self.assertFalse(user.is_cloaked)
+        self.assertFalse(request.session.__contains__.called)
+        self.assertFalse(async_to_sync(aget_user)(request, self.user).is_cloaked)
+        self.assertFalse(request.session.aget.called)
+
+        # a session cloaked without the cookie isn't picked up
+        session = self.client.session
+        session[SESSION_USER_KEY] = self.other_user.pk
+        session.save()
+        self.assertEqual("%s False" % self.user.pk, self.client.get(reverse("whoami")).content.decode())
+
+    def test_cloak_and_uncloak(self):
+        response = self.client.post(reverse("cloak", args=[self.other_user.pk]))
+        self.assertEqual("1", response.cookies["cloaked"].value)
+        self.assertEqual("%s True" % self.other_user.pk, self.client.get(reverse("whoami")).content.decode())
+
+        response = self.client.post(reverse("uncloak"))
+        self.assertEqual("", response.cookies["cloaked"].value)
+        self.assertEqual("%s False" % self.user.pk, self.client.get(reverse("whoami")).content.decode())
+
+    @override_settings(SESSION_COOKIE_DOMAIN=".example.com", SESSION_COOKIE_PATH="/app/")
+    def test_marker_goes_with_the_session_cookie(self):
+        response = self.client.post(reverse("cloak", args=[self.other_user.pk]))
+        self.assertEqual((".example.com", "/app/"), (response.cookies["cloaked"]["domain"], response.cookies["cloaked"]["path"]))
+
+        # otherwise the browser would keep a marker for another domain or path
+        response = self.client.post(reverse("uncloak"))
+        self.assertEqual((".example.com", "/app/"), (response.cookies["cloaked"]["domain"], response.cookies["cloaked"]["path"]))
+
+    @override_settings(CLOAK_AUDIT_LOG=True, CLOAK_AUDIT_BACKGROUND=False)
+    def test_audit_log_skips_requests_without_the_marker(self):
+        """
+        The audit log has to resolve the cloak on every request, which loads
+        the (database backed) session and the user, unless the marker says
+        there is no cloak
+        """
+        with self.assertNumQueries(0):
+            self.client.get(reverse("ping"))
+        with self.settings(CLOAK_MARKER_COOKIE=None):
+            with self.assertNumQueries(2):
+                self.client.get(reverse("ping"))
+
+        # cloaked requests have the marker, so they're still recorded
+        self.client.post(reverse("cloak", args=[self.other_user.pk]))
+        self.client.get(reverse("ping"))
+        get_audit_recorder().flush()
+        self.assertEqual([CloakEvent.CLOAK, CloakEvent.REQUEST], list(CloakEvent.objects.order_by("pk").values_list("kind", flat=True)))
+
+    def test_stale_marker_is_deleted(self):
+        self.client.post(reverse("cloak", args=[self.other_user.pk]))
+        session = self.client.session
+        del session[SESSION_USER_KEY]
+        session.save()
+
+        response = self.client.get(reverse("whoami"))
+        self.assertEqual("%s False" % self.user.pk, response.content.decode())
+        self.assertEqual("", response.cookies["cloaked"].value)
+
+
+class UserCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_disabled_by_default(self):
+        self.assertEqual(None, get_user_cache())
+
+    @override_settings(CLOAK_USER_CACHE_SIZE=10)
+    def test_cloaked_user_is_cached(self):
+        """
+        The second lookup of a cloaked user should come from the cache
+        """
+        user_to_cloak_as = make(get_user_model())
+        with self.assertNumQueries(1):
+            self.assertEqual(user_to_cloak_as, get_cloaked_user(user_to_cloak_as.pk))
+        with self.assertNumQueries(0):
+            user = get_cloaked_user(user_to_cloak_as.pk)
+        self.assertEqual(user_to_cloak_as, user)
+        self.assertEqual({"hits": 1, "misses": 1, "size": 1}, get_user_cache().stats())
+
+        # changes to the returned object don't affect the cache
+        user.is_cloaked = True
+        self.assertFalse(hasattr(get_cloaked_user(user_to_cloak_as.pk), "is_cloaked"))
+
+    @override_settings(CLOAK_USER_CACHE_SIZE=10)
+    def test_save_and_delete_invalidate_the_cache(self):
+        user_to_cloak_as = make(get_user_model(), first_name="foo")
+        get_cloaked_user(user_to_cloak_as.pk)
+
+        user_to_cloak_as.first_name = "bar"
+        user_to_cloak_as.save()
+        with self.assertNumQueries(1):
+            self.assertEqual("bar", get_cloaked_user(user_to_cloak_as.pk).first_name)
+
+        pk = user_to_cloak_as.pk
+        user_to_cloak_as.delete()
+        self.assertRaises(get_user_model().DoesNotExist, get_cloaked_user, pk)
+
+    @override_settings(CLOAK_CACHE_ALIAS="default")
+    def test_shared_cache(self):
+        """
+        With CLOAK_CACHE_ALIAS set, users are stored in Django's cache, and a
+        save bumps the version of the user's key
+        """
+        user_to_cloak_as = make(get_user_model(), first_name="foo")
+        self.assertIsInstance(get_user_cache(), SharedUserCache)
+        with self.assertNumQueries(1):
+            get_cloaked_user(user_to_cloak_as.pk)
+
+        # another process would have its own SharedUserCache object, but the
+        # same entries
+        other_process_cache = SharedUserCache(caches["default"])
+        self.assertEqual("foo", other_process_cache.get(user_to_cloak_as.pk).first_name)
+
+        version = cache.get("cloak.user.version.%s" % user_to_cloak_as.pk)
+        user_to_cloak_as.first_name = "bar"
+        user_to_cloak_as.save()
+        self.assertEqual(version + 1, cache.get("cloak.user.version.%s" % user_to_cloak_as.pk))
+        self.assertEqual(None, other_process_cache.get(user_to_cloak_as.pk))
+        with self.assertNumQueries(1):
+            self.assertEqual("bar", get_cloaked_user(user_to_cloak_as.pk).first_name)
+        with self.assertNumQueries(0):
+            self.assertEqual("bar", get_cloaked_user(user_to_cloak_as.pk).first_name)
+
+    def test_save_while_loading(self):
+        """
+        A user saved after the cache lookup, but before the loaded user is
+        stored, shouldn't be cached stale
+        """
+        user_to_cloak_as = make(get_user_model(), first_name="foo")
+        stale = get_user_model().objects.get(pk=user_to_cloak_as.pk)
+
+        def load(**kwargs):
+            # the save lands between the query and the cache set
+            user_to_cloak_as.first_name = "bar"
+            user_to_cloak_as.save()
+            return stale
+
+        for cache_settings in [{"CLOAK_CACHE_ALIAS": "default"}, {"CLOAK_USER_CACHE_SIZE": 10}]:
+            with self.settings(**cache_settings):
+                with patch("cloak.users.get_read_queryset") as get_read_queryset:
+                    get_read_queryset.return_value.get.side_effect = load
+                    self.assertEqual("foo", get_cloaked_user(user_to_cloak_as.pk).first_name)
+                self.assertEqual("bar", get_cloaked_user(user_to_cloak_as.pk).first_name)
+
+    def test_set_with_old_version(self):
+        shared = SharedUserCache(caches["default"])
+        user, version = shared.lookup(1)
+        shared.delete(1)
+        shared.set(1, "a", version)
+        self.assertEqual(None, shared.get(1))
+        shared.set(1, "a", shared.lookup(1)[1])
+        self.assertEqual("a", shared.get(1))
+
+        local = LocalUserCache(size=2)
+        user, version = local.lookup(1)
+        local.delete(2)
+        local.set(1, "a", version)
+        self.assertEqual(None, local.get(1))
+        local.set(1, "a", local.lookup(1)[1])
+        self.assertEqual("a", local.get(1))
+
+    def test_user_queryset_setting(self):
+        """
+        CLOAK_USER_QUERYSET lets the cloaked user be loaded with its related
+        objects
+        """
+        user_to_cloak_as = make(get_user_model())
+        user_to_cloak_as.groups.add(make(Group))
+        with self.settings(CLOAK_USER_QUERYSET="cloak.tests.user_queryset"):
+            with self.assertNumQueries(2):
+                user = get_cloaked_user(user_to_cloak_as.pk)
+                self.assertEqual(1, len(user.groups.all()))
+
+        with self.settings(CLOAK_USER_QUERYSET=lambda: get_user_model().objects.filter(is_active=False)):
+            self.assertRaises(get_user_model().DoesNotExist, get_cloaked_user, user_to_cloak_as.pk)
+
+    def test_lru_eviction(self):
+        cache = LocalUserCache(size=2)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        # touch 1, so 2 is the least recently used
+        cache.get(1)
+        cache.set(3, "c")
+        self.assertEqual(None, cache.get(2))
+        self.assertEqual("a", cache.get(1))
+        self.assertEqual("c", cache.get(3))
+
+    def test_ttl(self):
+        cache = LocalUserCache(size=2, ttl=10)
+        with patch("cloak.cache.time.time", return_value=100):
+            cache.set(1, "a")
+        with patch("cloak.cache.time.time", return_value=109):
+            self.assertEqual("a", cache.get(1))
+        with patch("cloak.cache.time.time", return_value=110):
+            self.assertEqual(None, cache.get(1))
+        self.assertEqual({"hits": 1, "misses": 1, "size": 0}, cache.stats())
+
+
+class ReadDatabaseTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_read_database(self):
+        user = make(get_user_model())
+        self.assertEqual("default", get_read_queryset(user.pk).db)
+        with self.settings(CLOAK_DB_ALIAS="replica"):
+            self.assertEqual("replica", get_read_queryset(user.pk).db)
+            self.assertEqual("replica", async_to_sync(aget_read_queryset)(user.pk).db)
+            # right after a save, the replica might be behind
+            user.save()
+            self.assertEqual("default", get_read_queryset(user.pk).db)
+            self.assertEqual("default", async_to_sync(aget_read_queryset)(user.pk).db)
+            cache.delete("cloak.saved.%s" % user.pk)
+            self.assertEqual("replica", get_read_queryset(user.pk).db)
+
+    def test_no_marker_without_read_database(self):
+        user = make(get_user_model())
+        user.save()
+        self.assertFalse(was_recently_saved(user.pk))
+
+    @override_settings(CLOAK_DB_ALIAS="replica", CLOAK_REPLICA_LAG=60)
+    def test_marker_timeout(self):
+        user = make(get_user_model())
+        with patch("django.core.cache.backends.locmem.LocMemCache.set") as set_:
+            user.save()
+        set_.assert_called_once_with("cloak.saved.%s" % user.pk, True, timeout=60)
+
 
 class CanCloakAsTest(TestCase):
     def test_is_staff_fallback(self):
@@ -103,6 +498,166 @@ class CanCloakAsTest(TestCase):
         other_user = make(get_user_model())
         self.assertFalse(can_cloak_as(user, other_user))
 
+    def test_decision_is_memoized_on_the_user(self):
+        """
+        Asking again for the same user object shouldn't call
+        User.can_cloak_as(other_user) again
+        """
+        user = make(get_user_model())
+        user.can_cloak_as = Mock(return_value=True)
+        other_user = make(get_user_model())
+        self.assertTrue(can_cloak_as(user, other_user))
+        self.assertTrue(can_cloak_as(user, other_user))
+        self.assertEqual(1, user.can_cloak_as.call_count)
+
+        # a fresh user object (i.e. the next request) asks again
+        user = get_user_model().objects.get(pk=user.pk)
+        user.can_cloak_as = Mock(return_value=False)
+        self.assertFalse(can_cloak_as(user, other_user))
+
+    @override_settings(CLOAK_PERMISSION_CACHE_TTL=60)
+    def test_decision_is_cached_across_requests(self):
+        cache.clear()
+        user = make(get_user_model())
+        other_user = make(get_user_model())
+        user.can_cloak_as = Mock(return_value=True)
+        self.assertTrue(can_cloak_as(user, other_user))
+
+        # the next request gets the cached decision
+        user = get_user_model().objects.get(pk=user.pk)
+        user.can_cloak_as = Mock(return_value=False)
+        self.assertTrue(can_cloak_as(user, other_user))
+        self.assertFalse(user.can_cloak_as.called)
+
+        # until it is invalidated, either by the user...
+        invalidate_can_cloak_as(user)
+        self.assertFalse(can_cloak_as(user, other_user))
+        self.assertEqual(1, user.can_cloak_as.call_count)
+
+        # ...or the other user
+        user = get_user_model().objects.get(pk=user.pk)
+        user.can_cloak_as = Mock(return_value=True)
+        invalidate_can_cloak_as(other_user)
+        self.assertTrue(can_cloak_as(user, other_user))
+
+        # ...or everything
+        user = get_user_model().objects.get(pk=user.pk)
+        user.can_cloak_as = Mock(return_value=False)
+        invalidate_can_cloak_as()
+        self.assertFalse(can_cloak_as(user, other_user))
+
+    def test_evicted_version_does_not_bring_back_old_decisions(self):
+        cache.clear()
+        user = make(get_user_model())
+        other_user = make(get_user_model())
+        permissions = PermissionCache(cache, 60)
+        permissions.set(user, other_user, True)
+        permissions.invalidate(user)
+        permissions.set(user, other_user, False)
+
+        cache.delete("cloak.perm.version.%s" % user.pk)
+        self.assertEqual(None, permissions.get(user, other_user))
+        cache.delete("cloak.perm.generation")
+        self.assertEqual(None, permissions.get(user, other_user))
+
+
+class CanCloakAsManyTest(TestCase):
+    def setUp(self):
+        self.other_users = [make(get_user_model()) for i in range(3)]
+        self.pks = set(other_user.pk for other_user in self.other_users)
+
+    def test_is_staff_fallback(self):
+        user = make(get_user_model(), is_staff=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.pks, can_cloak_as_many(user, get_user_model().objects.filter(pk__in=self.pks)))
+        self.assertEqual(set(), can_cloak_as_many(make(get_user_model(), is_staff=False), self.other_users))
+
+    def test_vectorized_method(self):
+        """
+        User.can_cloak_as_many(other_users) decides for all the users at once,
+        and the decisions are shared with can_cloak_as
+        """
+        user = make(get_user_model())
+        user.can_cloak_as = Mock(return_value=False)
+        user.can_cloak_as_many = Mock(return_value=[self.other_users[0].pk])
+        self.assertEqual(set([self.other_users[0].pk]), can_cloak_as_many(user, self.other_users))
+        user.can_cloak_as_many.assert_called_once_with(self.other_users)
+        self.assertTrue(can_cloak_as(user, self.other_users[0]))
+        self.assertFalse(can_cloak_as(user, self.other_users[1]))
+        self.assertFalse(user.can_cloak_as.called)
+
+        # only the undecided users are passed along next time
+        other_user = make(get_user_model())
+        user.can_cloak_as_many.return_value = [other_user.pk]
+        self.assertEqual(set([self.other_users[0].pk, other_user.pk]), can_cloak_as_many(user, self.other_users + [other_user]))
+        user.can_cloak_as_many.assert_called_with([other_user])
+
+    def test_per_object_fallback(self):
+        user = make(get_user_model())
+        user.can_cloak_as = Mock(side_effect=lambda other_user: other_user is not self.other_users[1])
+        can_cloak_as(user, self.other_users[0])
+        self.assertEqual(self.pks - set([self.other_users[1].pk]), can_cloak_as_many(user, self.other_users))
+        self.assertEqual(3, user.can_cloak_as.call_count)
+
+
+    @override_settings(CLOAK_PERMISSION_CACHE_TTL=60)
+    def test_permission_cache(self):
+        """
+        Decisions are shared with can_cloak_as through the permission cache,
+        across requests
+        """
+        cache.clear()
+        user = make(get_user_model())
+        user.can_cloak_as = Mock(side_effect=lambda other_user: other_user is self.other_users[0])
+        can_cloak_as(user, self.other_users[0])
+
+        # a new request, with a new user object
+        user = get_user_model().objects.get(pk=user.pk)
+        user.can_cloak_as = Mock(side_effect=lambda other_user: other_user is self.other_users[1])
+        self.assertEqual(set([self.other_users[0].pk, self.other_users[1].pk]), can_cloak_as_many(user, self.other_users))
+        self.assertEqual([self.other_users[1], self.other_users[2]], [args[0] for args, kwargs in user.can_cloak_as.call_args_list])
+
+        user = get_user_model().objects.get(pk=user.pk)
+        user.can_cloak_as = Mock(return_value=True)
+        self.assertFalse(can_cloak_as(user, self.other_users[2]))
+        self.assertFalse(user.can_cloak_as.called)
+
+    def test_attribute_errors_fall_back_to_is_staff(self):
+        """
+        Like can_cloak_as, a can_cloak_as method that raises AttributeError
+        falls back to the is_staff flag
+        """
+        user = make(get_user_model(), is_staff=True)
+        user.can_cloak_as = Mock(side_effect=AttributeError)
+        self.assertEqual(self.pks, can_cloak_as_many(user, self.other_users))
+
+class CloakAdminMixinTest(TestCase):
+    def test_cloak_button(self):
+        from django.contrib.admin import AdminSite, ModelAdmin
+        from django.test import RequestFactory
+        from .admin import CloakAdminMixin
+
+        class UserAdmin(CloakAdminMixin, ModelAdmin):
+            list_display = ("username",)
+            actions = None
+
+        user = make(get_user_model(), is_staff=True, is_superuser=True)
+        user.can_cloak_as_many = Mock(side_effect=lambda other_users: [other_users[0].pk])
+        # two more users for the changelist
+        make(get_user_model(), _quantity=2)
+        request = RequestFactory().get("/")
+        request.user = user
+
+        model_admin = UserAdmin(get_user_model(), AdminSite())
+        self.assertEqual(("username", "cloak_button"), model_admin.get_list_display(request))
+        with override_settings(ROOT_URLCONF="cloak.tests"):
+            changelist = model_admin.get_changelist_instance(request)
+            self.assertEqual(1, user.can_cloak_as_many.call_count)
+            buttons = [model_admin.cloak_button(obj) for obj in changelist.result_list]
+            self.assertIn('formaction="%s"' % reverse("cloak", args=[changelist.result_list[0].pk]), buttons[0])
+        self.assertEqual(["", ""], buttons[1:])
+        self.assertEqual(3, len(buttons))
+
 
 class LoginManagementCommandTest(TestCase):
     def test_favor_superusers_then_staffers(self):
@@ -152,7 +707,7 @@ class LoginManagementCommandTest(TestCase):
         user = make(get_user_model())
         stdout = tempfile.TemporaryFile(mode="w+")
         # we replace the TimestampSigner.sign method to return just the thing that it was passed because this ensures
-        with patch("cloak.management.commands.login.TimestampSigner.sign", Mock(return_value=str(user.pk))) as mock:
+        with patch("django.core.signing.TimestampSigner.sign", Mock(return_value=str(user.pk))) as mock:
             call_command("login", stdout=stdout)
             self.assertTrue(mock.called)
         stdout.seek(0)
@@ -204,6 +759,107 @@ class LoginManagementCommandTest(TestCase):
         content = stdout.read()
         self.assertIn("/cloak/login/%d" % user.pk, content)
 
+    def test_many_identifiers(self):
+        """
+        Many identifiers can be passed at once, and they are looked up in a
+        few queries, no matter how many there are
+        """
+        users = [make(get_user_model(), email="user%d@example.com" % i) for i in range(5)]
+        identifiers = [str(users[0].pk), users[1].email, users[2].get_username(), users[3].email, str(users[4].pk)]
+
+        stdout = tempfile.TemporaryFile(mode="w+")
+        with self.assertNumQueries(1):
+            call_command("login", *identifiers, stdout=stdout)
+        stdout.seek(0)
+        lines = stdout.read().splitlines()
+        self.assertEqual(5, len(lines))
+        for user, line in zip(users, lines):
+            self.assertTrue(line.startswith("/cloak/login/%d:" % user.pk))
+
+        # the batch size limits how many identifiers go into each query
+        with self.assertNumQueries(3):
+            call_command("login", *identifiers, batch_size=2, stdout=tempfile.TemporaryFile(mode="w+"))
+
+    def test_lookup_fields_setting(self):
+        """
+        CLOAK_LOGIN_LOOKUP_FIELDS decides which fields are searched, and which
+        one wins when an identifier matches more than one user
+        """
+        user = make(get_user_model(), username="foo", email="bar")
+        other_user = make(get_user_model(), username="bar", email="foo")
+
+        def login(identifier):
+            stdout = tempfile.TemporaryFile(mode="w+")
+            call_command("login", identifier, stdout=stdout, stderr=tempfile.TemporaryFile(mode="w+"))
+            stdout.seek(0)
+            return int(stdout.read().split("/")[-1].split(":")[0])
+
+        with self.settings(CLOAK_LOGIN_LOOKUP_FIELDS=["username", "email"]):
+            self.assertEqual(user.pk, login("foo"))
+        with self.settings(CLOAK_LOGIN_LOOKUP_FIELDS=["email", "username"]):
+            self.assertEqual(other_user.pk, login("foo"))
+        with self.settings(CLOAK_LOGIN_LOOKUP_FIELDS=["email"]):
+            self.assertRaises(CommandError, login, str(user.pk))
+
+    def test_lookup_fields_check(self):
+        """
+        Lookup fields that don't exist or aren't indexed should be reported by
+        the system check
+        """
+        # the default fields aren't checked, so the package doesn't warn about
+        # itself on a stock auth.User
+        self.assertEqual([], check_login_lookup_fields(None))
+        with self.settings(CLOAK_LOGIN_LOOKUP_FIELDS=["pk", "username"]):
+            self.assertEqual([], check_login_lookup_fields(None))
+
+        with self.settings(CLOAK_LOGIN_LOOKUP_FIELDS=["pk", "username", "email", "nope"]):
+            errors = check_login_lookup_fields(None)
+        self.assertEqual(["cloak.W001", "cloak.E001"], [error.id for error in errors])
+        self.assertEqual(get_user_model()._meta.get_field("email"), errors[0].obj)
+
+    def test_identifiers_from_a_file(self):
+        users = [make(get_user_model()) for i in range(3)]
+        with tempfile.NamedTemporaryFile(mode="w+") as f:
+            f.write("%s\n\n%s\n" % (users[1].get_username(), users[2].pk))
+            f.flush()
+
+            stdout = tempfile.TemporaryFile(mode="w+")
+            call_command("login", str(users[0].pk), file=f.name, format="json", stdout=stdout)
+        stdout.seek(0)
+        rows = [json.loads(line) for line in stdout.read().splitlines()]
+        self.assertEqual([user.pk for user in users], [row["pk"] for row in rows])
+        self.assertEqual([str(users[0].pk), users[1].get_username(), str(users[2].pk)], [row["identifier"] for row in rows])
+        self.assertTrue(rows[0]["path"].startswith("/cloak/login/%d:" % users[0].pk))
+
+    def test_missing_file(self):
+        with self.assertRaises(CommandError):
+            call_command("login", file="/nonexistent/identifiers.txt", stdout=tempfile.TemporaryFile(mode="w+"))
+
+    def test_json_output_with_uuid_pks(self):
+        pk = uuid.uuid4()
+        stdout = tempfile.TemporaryFile(mode="w+")
+        LoginCommand(stdout=stdout).get_writer("json")("foo", Mock(pk=pk), "/cloak/login/foo")
+        stdout.seek(0)
+        self.assertEqual({"identifier": "foo", "pk": str(pk), "path": "/cloak/login/foo"}, json.loads(stdout.read()))
+
+    def test_csv_output_and_missing_users(self):
+        """
+        Users that can't be found are reported, and the rest of the links are
+        still written out
+        """
+        user = make(get_user_model())
+        stdout = tempfile.TemporaryFile(mode="w+")
+        stderr = tempfile.TemporaryFile(mode="w+")
+        with self.assertRaises(CommandError):
+            call_command("login", "nobody", str(user.pk), format="csv", stdout=stdout, stderr=stderr)
+        stdout.seek(0)
+        rows = list(csv.reader(stdout))
+        self.assertEqual(["identifier", "pk", "path"], rows[0])
+        self.assertEqual([str(user.pk), str(user.pk)], rows[1][:2])
+        self.assertEqual(2, len(rows))
+        stderr.seek(0)
+        self.assertIn("nobody", stderr.read())
+
 
 class LoginViewTest(TestCase):
     def test_valid_signature_required(self):
@@ -235,6 +891,133 @@ class LoginViewTest(TestCase):
 
         self.assertNotIn('_auth_user_id', self.client.session.keys())
 
+    def test_single_use_link(self):
+        """
+        A single use link should only log the user in once
+        """
+        cache.clear()
+        user = make(get_user_model())
+        stdout = tempfile.TemporaryFile(mode="w+")
+        call_command("login", str(user.pk), single_use=True, stdout=stdout)
+        stdout.seek(0)
+        path = stdout.read().strip()
+
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(user.pk, int(self.client.session['_auth_user_id']))
+
+        self.client.logout()
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn('_auth_user_id', self.client.session.keys())
+
+        # every link has its own nonce
+        response = self.client.get(reverse(login, args=[make_login_signature(user, single_use=True)]))
+        self.assertEqual(response.status_code, 302)
+
+    def test_max_age_setting(self):
+        user = make(get_user_model())
+        signature = make_login_signature(user)
+        with self.settings(CLOAK_LOGIN_MAX_AGE=-1):
+            response = self.client.get(reverse(login, args=[signature]))
+        self.assertEqual(response.status_code, 403)
+
+        with self.settings(CLOAK_LOGIN_MAX_AGE=-1):
+            response = self.client.get(reverse(login, args=[make_login_signature(user, single_use=True)]))
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "dummy": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        "shared": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "cloak_cache"},
+    })
+    def test_nonce_store_check(self):
+        """
+        The default nonce store should warn about caches that aren't shared
+        between processes
+        """
+        self.assertEqual(["cloak.W003"], [error.id for error in check_nonce_store(None)])
+        with self.settings(CLOAK_CACHE_ALIAS="dummy"):
+            self.assertEqual(["cloak.W003"], [error.id for error in check_nonce_store(None)])
+        with self.settings(CLOAK_CACHE_ALIAS="shared"):
+            self.assertEqual([], check_nonce_store(None))
+        with self.settings(CLOAK_NONCE_STORE="myproject.nonces.NonceStore"):
+            self.assertEqual([], check_nonce_store(None))
+
+
+class LoginRateLimitTest(TestCase):
+    def test_malformed_signatures(self):
+        user = make(get_user_model())
+        self.assertTrue(is_well_formed_signature(make_login_signature(user)))
+        self.assertTrue(is_well_formed_signature(make_login_signature(user, single_use=True)))
+        for signature in ["", "junk", "1:abc", "1:a b:c", "1:abc:d+f", "1:abc:%s" % ("x" * 300)]:
+            self.assertFalse(is_well_formed_signature(signature))
+
+        # malformed signatures are turned away without checking them
+        with patch("cloak.views._unsign") as unsign:
+            response = self.client.get(reverse(login, args=["junk"]))
+        self.assertEqual(403, response.status_code)
+        self.assertFalse(unsign.called)
+
+        with self.settings(CLOAK_LOGIN_MAX_SIGNATURE_LENGTH=5):
+            self.assertFalse(is_well_formed_signature(make_login_signature(user)))
+
+    def test_token_bucket(self):
+        limiter = TokenBucketLimiter(rate=1, burst=2, size=2)
+        with patch("cloak.ratelimit.time.monotonic", return_value=100):
+            self.assertTrue(limiter.allow("a"))
+            self.assertTrue(limiter.allow("a"))
+            self.assertFalse(limiter.allow("a"))
+            self.assertTrue(limiter.allow("b"))
+        with patch("cloak.ratelimit.time.monotonic", return_value=101.5):
+            self.assertTrue(limiter.allow("a"))
+            self.assertFalse(limiter.allow("a"))
+            # only the most recently used buckets are kept
+            limiter.allow("c")
+        self.assertEqual(["a", "c"], list(limiter._buckets))
+
+    def test_cache_limiter(self):
+        cache.clear()
+        limiter = CacheLimiter(cache, 2, 60)
+        self.assertEqual([True, True, False], [limiter.allow("a") for i in range(3)])
+        self.assertTrue(limiter.allow("b"))
+
+    @override_settings(CLOAK_LOGIN_RATE=0.001, CLOAK_LOGIN_BURST=2, CLOAK_LOGIN_RATE_CACHE="default")
+    def test_rate_limited_view(self):
+        cache.clear()
+        user = make(get_user_model())
+        signature = make_login_signature(user)
+        self.assertEqual(302, self.client.get(reverse(login, args=[signature])).status_code)
+        self.assertEqual(403, self.client.get(reverse(login, args=["junk"])).status_code)
+        self.assertEqual(429, self.client.get(reverse(login, args=[signature])).status_code)
+        # other clients have their own limit
+        self.assertEqual(302, self.client.get(reverse(login, args=[signature]), REMOTE_ADDR="10.0.0.1").status_code)
+
+        async def alogin_request():
+            return await self.async_client.get(reverse("alogin", args=[signature]))
+        with self.settings(ROOT_URLCONF="cloak.tests"):
+            self.assertEqual(429, async_to_sync(alogin_request)().status_code)
+
+    @override_settings(CLOAK_IP_HEADER="HTTP_X_FORWARDED_FOR")
+    def test_client_ip(self):
+        request = HttpRequest()
+        request.META["HTTP_X_FORWARDED_FOR"] = "10.0.0.1, 10.0.0.2"
+        self.assertEqual("10.0.0.2", get_client_ip(request))
+        with self.settings(CLOAK_TRUSTED_PROXY_COUNT=2):
+            self.assertEqual("10.0.0.1", get_client_ip(request))
+        with self.settings(CLOAK_TRUSTED_PROXY_COUNT=3):
+            self.assertEqual("10.0.0.1", get_client_ip(request))
+
+    @override_settings(CLOAK_IP_HEADER="HTTP_X_FORWARDED_FOR", CLOAK_LOGIN_RATE=0.001, CLOAK_LOGIN_BURST=1)
+    def test_spoofed_addresses_share_a_bucket(self):
+        user = make(get_user_model())
+        signature = make_login_signature(user)
+        response = self.client.get(reverse(login, args=[signature]), HTTP_X_FORWARDED_FOR="1.1.1.1, 10.0.0.1")
+        self.assertEqual(302, response.status_code)
+        # making up a new leading address doesn't get the client a new bucket
+        response = self.client.get(reverse(login, args=[signature]), HTTP_X_FORWARDED_FOR="2.2.2.2, 10.0.0.1")
+        self.assertEqual(429, response.status_code)
+
 
 # the AuthenticationMiddleware wraps request.user in a
 # SimpleLazyObject, which makes testing harder. So we override it
@@ -309,3 +1092,675 @@ class CloakViewTest(TestCase):
             response = self.client.post(reverse("uncloak"), data={REDIRECT_FIELD_NAME: "/lame"})
         self.assertNotIn(SESSION_USER_KEY, self.client.session)
         self.assertRedirects(response, "/lame", target_status_code=404)
+
+
+@override_settings(ROOT_URLCONF="cloak.tests", CLOAK_SEARCH_PAGE_SIZE=2, CLOAK_SEARCH_FIELDS=["username", "email"])
+class SearchViewTest(TestCase):
+    def setUp(self):
+        self.user = make(get_user_model(), username="admin", is_staff=True)
+        self.client.force_login(self.user)
+        self.users = [make(get_user_model(), username="alice%d" % i) for i in range(5)]
+        make(get_user_model(), username="bob", email="alice@example.com")
+
+    def search(self, **params):
+        response = self.client.get(reverse("cloak-search"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_search(self):
+        """
+        Users are matched by the start of their username, then their email,
+        and returned a page at a time
+        """
+        data = self.search(q="alice")
+        self.assertEqual([{"pk": user.pk, "label": user.username} for user in self.users[:2]], data["results"])
+        self.assertEqual([0, "alice1", self.users[1].pk], json.loads(data["next"]))
+
+        data = self.search(q="alice", cursor=data["next"])
+        self.assertEqual([user.pk for user in self.users[2:4]], [result["pk"] for result in data["results"]])
+
+        # the last page of usernames, then the emails
+        data = self.search(q="alice", cursor=data["next"])
+        self.assertEqual(["alice4", "bob"], [result["label"] for result in data["results"]])
+        self.assertEqual(None, data["next"])
+
+        data = self.search(q="b")
+        self.assertEqual(["bob"], [result["label"] for result in data["results"]])
+        self.assertEqual(None, data["next"])
+
+        with self.settings(CLOAK_SEARCH_FIELDS=["username"]):
+            self.assertEqual([], self.search(q="alice", cursor=json.dumps([0, "alice4", self.users[-1].pk]))["results"])
+
+    def test_users_matched_by_two_fields(self):
+        """
+        A user whose username and email both match is only returned once, and
+        the pages of one field are ordered by that field
+        """
+        self.users[0].email = "alice@example.com"
+        self.users[0].save()
+        carol = make(get_user_model(), username="carol", email="alice@example.org")
+        data = self.search(q="alice", cursor=json.dumps([1, None, None]))
+        self.assertEqual(["bob", "carol"], [result["label"] for result in data["results"]])
+        # the next page of emails starts after the last one
+        self.assertEqual([1, "alice@example.org", carol.pk], json.loads(data["next"]))
+
+    def test_only_users_the_requester_can_cloak_as(self):
+        allowed = set([self.users[1].pk, self.users[4].pk])
+        with patch("cloak.views.can_cloak_as_many", side_effect=lambda user, other_users: allowed & set(other_user.pk for other_user in other_users)):
+            data = self.search(q="alice")
+        self.assertEqual(sorted(allowed), [result["pk"] for result in data["results"]])
+
+        # with no one to cloak as, the search stops after a few pages
+        with self.settings(CLOAK_SEARCH_PAGE_SIZE=1), patch("cloak.views.can_cloak_as_many", return_value=set()):
+            data = self.search()
+        self.assertEqual([], data["results"])
+        self.assertEqual([0, self.users[3].pk, self.users[3].pk], json.loads(data["next"]))
+
+    def test_queries(self):
+        # the session, the requester, and one query per page scanned
+        with self.assertNumQueries(3):
+            self.search(q="alice")
+
+    def test_bad_requests(self):
+        for cursor in ("x", "[0]", "[1, null, null]", "[-1, null, null]", '[0, "x", 1]', "{}"):
+            self.assertEqual(400, self.client.get(reverse("cloak-search"), {"cursor": cursor}).status_code)
+        self.client.logout()
+        self.assertEqual(302, self.client.get(reverse("cloak-search")).status_code)
+
+    def test_search_fields_check(self):
+        # the email field of auth.User isn't indexed
+        self.assertEqual(["cloak.W002"], [error.id for error in check_search_fields(None)])
+        # the default, the username, is
+        with self.settings(CLOAK_SEARCH_FIELDS=None):
+            self.assertEqual([], check_search_fields(None))
+        with self.settings(CLOAK_SEARCH_FIELDS=["username", "username__istartswith"]):
+            self.assertEqual([], check_search_fields(None))
+        # relation paths aren't supported
+        with self.settings(CLOAK_SEARCH_FIELDS=["groups__name", "username__nope", "groups__name__startswith"]):
+            self.assertEqual(["cloak.E002"] * 3, [error.id for error in check_search_fields(None)])
+        with self.settings(CLOAK_SEARCH_FIELDS=["username", "email", "nope"]):
+            errors = check_search_fields(None)
+        self.assertEqual(["cloak.W002", "cloak.E002"], [error.id for error in errors])
+
+
+@override_settings(ROOT_URLCONF="cloak.tests", CLOAK_SESSION_REGISTRY=True)
+class SessionRegistryTest(TestCase):
+    def cloak(self, actor, target):
+        client = Client()
+        client.force_login(actor)
+        client.post(reverse("cloak", args=[target.pk]))
+        return client
+
+    def test_cloak_and_uncloak(self):
+        actor = make(get_user_model(), is_staff=True)
+        target = make(get_user_model())
+        client = self.cloak(actor, target)
+        cloak_session = CloakSession.objects.get()
+        self.assertEqual((str(actor.pk), str(target.pk), client.session.session_key), (cloak_session.actor_pk, cloak_session.target_pk, cloak_session.session_key))
+
+        client.post(reverse("uncloak"))
+        self.assertFalse(CloakSession.objects.exists())
+
+        with self.settings(CLOAK_SESSION_REGISTRY=False):
+            self.cloak(actor, target)
+        self.assertFalse(CloakSession.objects.exists())
+
+    def test_revoke(self):
+        actors = [make(get_user_model(), is_staff=True) for i in range(2)]
+        targets = [make(get_user_model()) for i in range(2)]
+        clients = [self.cloak(actors[0], targets[0]), self.cloak(actors[1], targets[0]), self.cloak(actors[0], targets[1])]
+
+        with self.assertNumQueries(10):
+            # find the sessions, load and save both (in savepoints), and
+            # forget them
+            self.assertEqual(2, revoke(target=targets[0]))
+        self.assertNotIn(SESSION_USER_KEY, clients[0].session)
+        self.assertNotIn(SESSION_USER_KEY, clients[1].session)
+        self.assertEqual(targets[1].pk, clients[2].session[SESSION_USER_KEY])
+        self.assertEqual(1, CloakSession.objects.count())
+
+        self.assertEqual(0, revoke(actor=actors[1]))
+        self.assertRaises(ValueError, revoke)
+
+    def test_sessions_that_moved_on_are_left_alone(self):
+        actor = make(get_user_model(), is_staff=True)
+        target = make(get_user_model())
+        client = self.cloak(actor, target)
+        # the registry missed this change of cloak
+        session = client.session
+        session[SESSION_USER_KEY] = actor.pk
+        session.save()
+
+        self.assertEqual(0, revoke(actor=actor))
+        self.assertEqual(actor.pk, client.session[SESSION_USER_KEY])
+        self.assertFalse(CloakSession.objects.exists())
+
+    def test_cycled_session_key(self):
+        """
+        The registry entry follows the session to its new key, so the session
+        can still be revoked
+        """
+        actor = make(get_user_model(), is_staff=True)
+        client = self.cloak(actor, make(get_user_model()))
+        old_key = client.session.session_key
+        client.get(reverse("cycle"))
+        self.assertNotEqual(old_key, client.session.session_key)
+        self.assertEqual(client.session.session_key, CloakSession.objects.get().session_key)
+
+        self.assertEqual(1, revoke(actor=actor))
+        self.assertNotIn(SESSION_USER_KEY, client.session)
+
+    def test_prune(self):
+        actor = make(get_user_model(), is_staff=True)
+        target = make(get_user_model())
+        clients = [self.cloak(actor, target) for i in range(3)]
+        # logged out, and expired
+        clients[0].logout()
+        clients[1].session.delete()
+
+        stdout = tempfile.TemporaryFile(mode="w+")
+        call_command("cloak_clearsessions", stdout=stdout)
+        stdout.seek(0)
+        self.assertEqual("Removed 2 stale cloak sessions\n", stdout.read())
+        self.assertEqual([clients[2].session.session_key], list(CloakSession.objects.values_list("session_key", flat=True)))
+        self.assertEqual(0, prune())
+
+    def test_command(self):
+        actor = make(get_user_model(), is_staff=True)
+        client = self.cloak(actor, make(get_user_model()))
+        stdout = tempfile.TemporaryFile(mode="w+")
+        call_command("cloak_revoke", actor=str(actor.pk), stdout=stdout)
+        stdout.seek(0)
+        self.assertEqual("Revoked 1 cloak session\n", stdout.read())
+        self.assertNotIn(SESSION_USER_KEY, client.session)
+        self.assertRaises(CommandError, call_command, "cloak_revoke")
+
+
+class CloakCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.actor = make(get_user_model(), is_staff=True)
+        self.other_user = make(get_user_model())
+
+    def cloaked(self):
+        user = get_user_model().objects.get(pk=self.other_user.pk)
+        user.is_cloaked = True
+        user.cloak_actor = self.actor
+        return user
+
+    def request(self, user):
+        request = HttpRequest()
+        request.method = "GET"
+        request.path = "/page"
+        request.META["SERVER_NAME"] = "testserver"
+        request.META["SERVER_PORT"] = "80"
+        request.user = user
+        return request
+
+    def test_cloak_cache_key(self):
+        from django.contrib.auth.models import AnonymousUser
+        self.assertEqual("anonymous", cloak_cache_key(self.request(AnonymousUser())))
+        self.assertEqual("user.%s" % self.actor.pk, cloak_cache_key(self.request(self.actor)))
+        self.assertEqual("cloak.%s.%s" % (self.actor.pk, self.other_user.pk), cloak_cache_key(self.request(self.cloaked())))
+        self.assertEqual("user.%s" % self.other_user.pk, cloak_cache_key(self.request(self.other_user)))
+
+    def test_cloak_cache_page(self):
+        calls = []
+
+        @cloak_cache_page(60, key_prefix="site")
+        def view(request):
+            calls.append(request.user)
+            return HttpResponse(str(request.user.pk))
+
+        for user in [self.actor, self.cloaked(), self.other_user, self.actor, self.cloaked(), self.other_user]:
+            self.assertEqual(str(user.pk), view(self.request(user)).content.decode())
+        # each user and the cloak only rendered the page once
+        self.assertEqual(3, len(calls))
+
+    def test_cloak_cache_page_builds_the_middleware_once(self):
+        with patch.object(CloakCacheMiddleware, "__init__", autospec=True, side_effect=CloakCacheMiddleware.__init__) as init:
+            view = cloak_cache_page(60)(lambda request: HttpResponse(str(request.user.pk)))
+            for user in [self.actor, self.cloaked(), self.actor]:
+                self.assertEqual(str(user.pk), view(self.request(user)).content.decode())
+        self.assertEqual(1, init.call_count)
+
+    def test_vary_on_cloak(self):
+        """
+        With the site wide cache middleware, pages that vary on the cloak are
+        cached for each actor and cloaked user pair
+        """
+        middleware = ["django.middleware.cache.UpdateCacheMiddleware"] + settings.MIDDLEWARE + ["django.middleware.cache.FetchFromCacheMiddleware"]
+        with self.settings(ROOT_URLCONF="cloak.tests", MIDDLEWARE=middleware):
+            client = Client()
+            client.force_login(self.actor)
+            response = client.get(reverse("cached-whoami"))
+            self.assertIn("X-Cloak-Key", response["Vary"])
+            self.assertEqual("%s False" % self.actor.pk, response.content.decode())
+
+            session = client.session
+            session[SESSION_USER_KEY] = self.other_user.pk
+            session.save()
+            self.assertEqual("%s True" % self.other_user.pk, client.get(reverse("cached-whoami")).content.decode())
+
+            # the pages are cached, but sending the header doesn't get you
+            # someone else's
+            with patch("cloak.tests.whoami", return_value=HttpResponse("rendered")):
+                self.assertEqual("%s True" % self.other_user.pk, client.get(reverse("cached-whoami")).content.decode())
+                self.assertEqual("rendered", Client().get(reverse("cached-whoami"), HTTP_X_CLOAK_KEY="user.%s" % self.actor.pk).content.decode())
+
+    def test_cloakcache_tag(self):
+        from django.template import Context, Engine, TemplateSyntaxError
+        engine = Engine(libraries={"cloak": "cloak.templatetags.cloak"})
+        template = engine.from_string("{% load cloak %}{% cloakcache 60 greeting %}{{ user.pk }}{% endcloakcache %}")
+
+        self.assertEqual(str(self.actor.pk), template.render(Context({"user": self.actor, "request": self.request(self.actor)})))
+        # the actor's fragment isn't reused while they're cloaked...
+        self.assertEqual(str(self.other_user.pk), template.render(Context({"user": self.cloaked()})))
+        # ...but it is reused otherwise
+        self.assertEqual(str(self.actor.pk), template.render(Context({"user": None, "request": self.request(self.actor)})))
+        self.assertEqual(str(self.other_user.pk), template.render(Context({"user": self.cloaked()})))
+
+        self.assertRaises(TemplateSyntaxError, template.render, Context({}))
+        self.assertRaises(TemplateSyntaxError, engine.from_string, "{% load cloak %}{% cloakcache 60 %}{% endcloakcache %}")
+
+
+@override_settings(ROOT_URLCONF="cloak.tests")
+class CloakBannerTest(TestCase):
+    def setUp(self):
+        self.actor = make(get_user_model(), username="actor", is_staff=True)
+        self.other_user = make(get_user_model(), username="target")
+
+    def request(self, user):
+        request = HttpRequest()
+        request.user = user
+        return request
+
+    def test_context_processor(self):
+        user = get_user_model().objects.get(pk=self.other_user.pk)
+        user.is_cloaked = True
+        user.cloak_actor = self.actor
+        context = cloak_context_processor(self.request(user))["cloak"]
+        self.assertEqual((True, self.actor, user), (context["is_cloaked"], context["actor"], context["user"]))
+
+        context = cloak_context_processor(self.request(self.actor))["cloak"]
+        self.assertEqual((False, None), (context["is_cloaked"], context["actor"]))
+
+        # the cloak isn't resolved until the template uses it
+        request = HttpRequest()
+        request.user = SimpleLazyObject(lambda: self.fail("request.user was resolved"))
+        cloak_context_processor(request)
+
+    def test_banner(self):
+        user = get_user_model().objects.get(pk=self.other_user.pk)
+        user.is_cloaked = True
+        user.cloak_actor = self.actor
+        with self.assertNumQueries(0):
+            html = render_banner({"request": self.request(user), "csrf_token": "token"})
+        self.assertIn("actor, you are cloaked as target.", html)
+        self.assertIn('action="%s"' % reverse("uncloak"), html)
+        self.assertIn('value="token"', html)
+
+        self.assertEqual("", render_banner({"request": self.request(self.actor)}).strip())
+        self.assertEqual("", render_banner({}).strip())
+
+    def test_banner_adds_no_queries(self):
+        self.client.force_login(self.actor)
+        session = self.client.session
+        session[SESSION_USER_KEY] = self.other_user.pk
+        session.save()
+
+        with CaptureQueriesContext(connection) as whoami_queries:
+            self.client.get(reverse("whoami"))
+        with CaptureQueriesContext(connection) as banner_queries:
+            response = self.client.get(reverse("banner"))
+        self.assertIn("you are cloaked as target", response.content.decode())
+        self.assertEqual(len(whoami_queries), len(banner_queries))
+
+
+@override_settings(ROOT_URLCONF="cloak.tests")
+class QueryCountTest(TestCase):
+    """
+    Guards against the middleware making more queries than it has to. The
+    baseline is the same request without the middleware
+    """
+    middleware = [
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+    ]
+
+    def setUp(self):
+        cache.clear()
+        self.user = make(get_user_model(), is_staff=True)
+        self.to_cloak_as = make(get_user_model())
+
+    def assertQueries(self, extra):
+        """
+        Asserts a request to the whoami view makes `extra` more queries with
+        the middleware than without it
+        """
+        # a client only loads the middleware once, so the baseline needs its
+        # own client
+        client = Client()
+        client.cookies = self.client.cookies
+        with self.settings(MIDDLEWARE=self.middleware):
+            with CaptureQueriesContext(connection) as baseline:
+                client.get(reverse("whoami"))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("whoami"))
+        self.assertEqual(len(baseline) + extra, len(queries), "\n".join(query["sql"] for query in queries))
+
+    def cloak(self):
+        session = self.client.session
+        session[SESSION_USER_KEY] = self.to_cloak_as.pk
+        session.save()
+
+    def test_anonymous(self):
+        self.assertQueries(0)
+
+    def test_authenticated(self):
+        self.client.force_login(self.user)
+        self.assertQueries(0)
+
+    def test_cloaked(self):
+        self.client.force_login(self.user)
+        self.cloak()
+        # just the cloaked user
+        self.assertQueries(1)
+
+    @override_settings(CLOAK_USER_CACHE_SIZE=10, CLOAK_PERMISSION_CACHE_TTL=60)
+    def test_cloaked_with_warm_caches(self):
+        self.client.force_login(self.user)
+        self.cloak()
+        self.client.get(reverse("whoami"))
+        self.assertQueries(0)
+
+    @override_settings(CLOAK_CACHE_ALIAS="default", CLOAK_PERMISSION_CACHE_TTL=60)
+    def test_cloaked_with_warm_shared_cache(self):
+        self.client.force_login(self.user)
+        self.cloak()
+        self.client.get(reverse("whoami"))
+        self.assertQueries(0)
+
+
+class RecordingStatsCollector(BaseStatsCollector):
+    events = []
+
+    def timing(self, name, duration, tags):
+        self.events.append(("timing", name, tags))
+
+    def incr(self, name, tags):
+        self.events.append(("incr", name, tags))
+
+
+@override_settings(ROOT_URLCONF="cloak.tests")
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.user = make(get_user_model(), is_staff=True)
+        self.to_cloak_as = make(get_user_model())
+        self.client.force_login(self.user)
+        session = self.client.session
+        session[SESSION_USER_KEY] = self.to_cloak_as.pk
+        session.save()
+
+    def test_nothing_is_recorded_by_default(self):
+        response = self.client.get(reverse("whoami"))
+        self.assertFalse(response.has_header("Server-Timing"))
+
+    def test_signal(self):
+        events = []
+        def receiver(sender, **kwargs):
+            events.append(kwargs)
+        cloak_timing.connect(receiver)
+        try:
+            with self.settings(CLOAK_USER_CACHE_SIZE=10):
+                self.client.get(reverse("whoami"))
+        finally:
+            cloak_timing.disconnect(receiver)
+
+        self.assertEqual(["resolve", "permission"], [event["name"] for event in events])
+        self.assertEqual("found", events[0]["outcome"])
+        self.assertEqual("miss", events[0]["cache"])
+        # only the cloaked user. The session and the real user are loaded
+        # before the cloak is resolved
+        self.assertEqual(1, events[0]["queries"])
+        self.assertIsInstance(events[0]["request"], HttpRequest)
+        self.assertEqual("allowed", events[1]["outcome"])
+        self.assertEqual(0, events[1]["queries"])
+
+    @override_settings(CLOAK_STATS_COLLECTOR="cloak.tests.RecordingStatsCollector")
+    def test_stats_collector(self):
+        RecordingStatsCollector.events = []
+        self.client.post(reverse("uncloak"))
+        self.assertIn(("incr", "cloak.uncloak", {"outcome": "uncloaked"}), RecordingStatsCollector.events)
+        self.assertIn(("timing", "cloak.uncloak", {"outcome": "uncloaked"}), RecordingStatsCollector.events)
+
+    @override_settings(CLOAK_SERVER_TIMING=True)
+    def test_server_timing(self):
+        response = self.client.get(reverse("whoami"))
+        self.assertRegex(response["Server-Timing"], r"^cloak-resolve;dur=[0-9.]+, cloak-permission;dur=[0-9.]+$")
+
+
+@override_settings(ROOT_URLCONF="cloak.tests", CLOAK_AUDIT_LOG=True, CLOAK_AUDIT_BACKGROUND=False, CLOAK_AUDIT_BATCH_SIZE=3)
+class AuditLogTest(TestCase):
+    def setUp(self):
+        self.user = make(get_user_model(), is_staff=True)
+        self.to_cloak_as = make(get_user_model())
+        self.client.force_login(self.user)
+
+    def test_cloak_session_is_recorded_in_batches(self):
+        self.client.post(reverse("cloak", args=[self.to_cloak_as.pk]))
+        self.client.get(reverse("whoami") + "?foo=bar")
+        # nothing is written until there is a full batch
+        self.assertEqual(0, CloakEvent.objects.count())
+
+        # the third event fills the batch, which is written with one insert
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse("uncloak"))
+        inserts = [query for query in queries if query["sql"].startswith("INSERT")]
+        self.assertEqual(1, len(inserts))
+
+        events = list(CloakEvent.objects.values_list("kind", "actor_pk", "target_pk", "path", "status_code"))
+        self.assertEqual([
+            (CloakEvent.CLOAK, str(self.user.pk), str(self.to_cloak_as.pk), reverse("cloak", args=[self.to_cloak_as.pk]), None),
+            (CloakEvent.REQUEST, str(self.user.pk), str(self.to_cloak_as.pk), reverse("whoami") + "?foo=bar", 200),
+            (CloakEvent.UNCLOAK, str(self.user.pk), str(self.to_cloak_as.pk), reverse("uncloak"), None),
+        ], events)
+
+        # requests that aren't cloaked aren't recorded
+        self.client.get(reverse("whoami"))
+        get_audit_recorder().flush()
+        # the uncloak request itself is the 4th event
+        self.assertEqual(4, CloakEvent.objects.count())
+
+    def test_flush_interval(self):
+        with self.settings(CLOAK_AUDIT_FLUSH_INTERVAL=0):
+            self.client.post(reverse("cloak", args=[self.to_cloak_as.pk]))
+            self.assertEqual(1, CloakEvent.objects.count())
+
+    def test_full_queue_drops_events(self):
+        recorder = AuditRecorder(queue_size=1, batch_size=10, background=False)
+        recorder.record(CloakEvent.CLOAK, self.user, self.to_cloak_as)
+        recorder.record(CloakEvent.CLOAK, self.user, self.to_cloak_as)
+        self.assertEqual(1, recorder.dropped)
+        recorder.flush()
+        self.assertEqual(1, CloakEvent.objects.count())
+
+    def test_full_queue_warns_once_per_interval(self):
+        recorder = AuditRecorder(queue_size=1, batch_size=10, flush_interval=60, background=False)
+        with patch("cloak.audit.logger") as logger:
+            for i in range(4):
+                recorder.record(CloakEvent.CLOAK, self.user, self.to_cloak_as)
+            logger.warning.assert_called_once_with("The cloak audit log queue is full, %d events have been dropped so far", 1)
+
+            recorder._last_warning -= 60
+            recorder.record(CloakEvent.CLOAK, self.user, self.to_cloak_as)
+            logger.warning.assert_called_with("The cloak audit log queue is full, %d events have been dropped so far", 4)
+        self.assertEqual(2, logger.warning.call_count)
+
+    def test_background_thread(self):
+        recorder = AuditRecorder(batch_size=2, flush_interval=10)
+        batches = []
+        written = threading.Event()
+        def write(batch):
+            batches.append(batch)
+            written.set()
+        recorder.write = write
+        with patch("cloak.audit.close_old_connections"):
+            for i in range(3):
+                recorder.record(CloakEvent.CLOAK, self.user, self.to_cloak_as)
+            self.assertTrue(written.wait(5))
+        # the first batch is full, so it's written right away
+        self.assertEqual([2], [len(batch) for batch in batches])
+
+    def test_flush_writes_the_pending_batch(self):
+        """
+        The events the background thread took off the queue, but hasn't
+        written yet, are written by a flush (like the one at exit)
+        """
+        recorder = AuditRecorder(batch_size=10, flush_interval=60)
+        batches = []
+        recorder.write = batches.append
+        recorder.record(CloakEvent.CLOAK, self.user, self.to_cloak_as)
+        recorder.record(CloakEvent.UNCLOAK, self.user, self.to_cloak_as)
+        deadline = time.monotonic() + 5
+        while len(recorder._pending) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(recorder.queue.empty())
+
+        recorder.flush()
+        self.assertEqual([[CloakEvent.CLOAK, CloakEvent.UNCLOAK]], [[event.kind for event in batch] for batch in batches])
+
+
+@override_settings(CLOAK_SIGNED_TOKEN=True)
+@patch("django.contrib.auth.middleware.SimpleLazyObject", lambda func: func())
+class SignedTokenTest(TestCase):
+    def setUp(self):
+        self.user = prepare(get_user_model())
+        self.user.set_password("foobar")
+        self.user.save()
+        self.to_cloak_as = make(get_user_model())
+
+    def test_token_is_only_good_for_its_user(self):
+        token = make_token(self.user, self.to_cloak_as)
+        self.assertEqual(str(self.to_cloak_as.pk), read_token(token, self.user))
+        self.assertEqual(None, read_token(token, self.to_cloak_as))
+        self.assertEqual(None, read_token(token + "x", self.user))
+        with self.settings(CLOAK_TOKEN_MAX_AGE=-1):
+            self.assertEqual(None, read_token(token, self.user))
+
+    def test_cloak_with_a_cookie(self):
+        """
+        The cloak view should set a cookie with the token instead of touching
+        the session, and the middleware should cloak using the cookie
+        """
+        self.client.login(username=self.user.username, password="foobar")
+        with patch("cloak.views.can_cloak_as", return_value=True):
+            response = self.client.post(reverse("cloak", args=[self.to_cloak_as.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(SESSION_USER_KEY, self.client.session)
+        self.assertEqual(str(self.to_cloak_as.pk), read_token(response.cookies["cloak_token"].value, self.user))
+
+        # the middleware still checks can_cloak_as
+        with patch("cloak.middleware.can_cloak_as", return_value=False):
+            with patch("cloak.views.can_cloak_as", Mock(return_value=False)) as mock:
+                self.client.post(reverse("cloak", args=[self.user.pk]))
+                mock.assert_called_once_with(self.user, self.user)
+
+        with patch("cloak.middleware.can_cloak_as", return_value=True):
+            with patch("cloak.views.can_cloak_as", Mock(return_value=False)) as mock:
+                self.client.post(reverse("cloak", args=[self.user.pk]))
+                mock.assert_called_once_with(self.to_cloak_as, self.user)
+
+        response = self.client.post(reverse("uncloak"))
+        self.assertEqual("", response.cookies["cloak_token"].value)
+
+    def test_cloak_with_a_header(self):
+        self.client.login(username=self.user.username, password="foobar")
+        token = make_token(self.user, self.to_cloak_as)
+        with patch("cloak.middleware.can_cloak_as", return_value=True):
+            with patch("cloak.views.can_cloak_as", Mock(return_value=False)) as mock:
+                self.client.post(reverse("cloak", args=[self.user.pk]), HTTP_X_CLOAK_TOKEN=token)
+                mock.assert_called_once_with(self.to_cloak_as, self.user)
+
+
+@override_settings(ROOT_URLCONF="cloak.tests")
+class AsyncViewTest(TestCase):
+    def setUp(self):
+        self.user = prepare(get_user_model())
+        self.user.set_password("foobar")
+        self.user.save()
+        self.to_cloak_as = make(get_user_model())
+
+    async def request(self, method, path, data=None):
+        """
+        Make a request with the async client, which runs the middleware and
+        views in async mode
+        """
+        if method == "post":
+            return await self.async_client.post(path, urlencode(data or {}), content_type="application/x-www-form-urlencoded")
+        return await self.async_client.get(path)
+
+    async def login(self):
+        await sync_to_async(self.async_client.login)(username=self.user.username, password="foobar")
+
+    async def session(self):
+        # loading the session is a query
+        return await sync_to_async(lambda: dict(self.async_client.session.items()))()
+
+    async def test_cloak_and_uncloak(self):
+        """
+        The async views should cloak and uncloak, and the middleware should
+        resolve the cloaked user for request.auser()
+        """
+        await self.login()
+        with patch("cloak.views.can_cloak_as", return_value=True):
+            response = await self.request("post", reverse("acloak", args=[self.to_cloak_as.pk]), {REDIRECT_FIELD_NAME: "/bar"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, "/bar")
+        self.assertEqual((await self.session())[SESSION_USER_KEY], self.to_cloak_as.pk)
+
+        # the view gets the cloaked user from request.auser()
+        with patch("cloak.middleware.can_cloak_as", return_value=True):
+            with patch("cloak.views.can_cloak_as", Mock(return_value=False)) as mock:
+                response = await self.request("post", reverse("acloak", args=[self.user.pk]))
+                mock.assert_called_once_with(self.to_cloak_as, self.user)
+        self.assertEqual(response.status_code, 403)
+
+        response = await self.request("post", reverse("auncloak"), {REDIRECT_FIELD_NAME: "/lame"})
+        self.assertEqual(response.url, "/lame")
+        self.assertNotIn(SESSION_USER_KEY, await self.session())
+
+    @override_settings(CLOAK_AUDIT_LOG=True, CLOAK_AUDIT_BACKGROUND=False, CLOAK_AUDIT_BATCH_SIZE=1)
+    async def test_audit_log(self):
+        """
+        The async views and middleware write the audit log from a thread,
+        since they can't touch the database on the event loop
+        """
+        await self.login()
+        with patch("cloak.views.can_cloak_as", return_value=True):
+            await self.request("post", reverse("acloak", args=[self.to_cloak_as.pk]))
+        with patch("cloak.middleware.can_cloak_as", return_value=True):
+            await self.request("get", reverse("whoami"))
+            await self.request("post", reverse("auncloak"))
+
+        kinds = await sync_to_async(list)(CloakEvent.objects.order_by("pk").values_list("kind", flat=True))
+        # the uncloak request was made while cloaked, so it's recorded too
+        self.assertEqual([CloakEvent.CLOAK, CloakEvent.REQUEST, CloakEvent.UNCLOAK, CloakEvent.REQUEST], kinds)
+
+    async def test_cloak_requires_login_and_post(self):
+        response = await self.request("post", reverse("acloak", args=[self.to_cloak_as.pk]))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("/accounts/login/", response.url)
+
+        response = await self.request("get", reverse("acloak", args=[self.to_cloak_as.pk]))
+        self.assertEqual(response.status_code, 405)
+
+    async def test_login(self):
+        with self.settings(LOGIN_REDIRECT_URL="/foo"):
+            response = await self.request("get", reverse("alogin", args=[TimestampSigner().sign(str(self.user.pk))]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, "/foo")
+        self.assertEqual(self.user.pk, int((await self.session())['_auth_user_id']))
+
+        response = await self.request("get", reverse("alogin", args=["garbage"]))
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,151 @@
+"""
+Signed login links, and signed cloak tokens.
+
+Login links are made by the login command, and are good for
+CLOAK_LOGIN_MAX_AGE seconds. Single use links also carry a nonce, which the
+login view checks against the nonce store.
+
+Signed cloak tokens carry the cloak in a cookie or request header instead of
+the session.
+
+Set CLOAK_SIGNED_TOKEN = True to use them. The cloak view then sets the token
+in the CLOAK_TOKEN_COOKIE_NAME cookie, and the middleware also accepts it in
+the CLOAK_TOKEN_HEADER header (for clients without cookies). A token is only
+good for the user it was made for, and for CLOAK_TOKEN_MAX_AGE seconds.
+
+With session cloaks, setting CLOAK_MARKER_COOKIE to a cookie name makes the
+cloak view set that cookie too (and the uncloak view delete it), so the
+middleware only looks in the session for a cloak when the cookie is there.
+"""
+from django.conf import settings
+from django.core import signing
+
+from . import MAX_AGE_OF_SIGNATURE_IN_SECONDS
+from .nonces import make_nonce
+
+LOGIN_SINGLE_USE_SALT = "cloak.login.single-use"
+TOKEN_SALT = "cloak.token"
+TOKEN_COOKIE_NAME = "cloak_token"
+TOKEN_HEADER = "HTTP_X_CLOAK_TOKEN"
+TOKEN_MAX_AGE = 60 * 60 * 8
+
+
+def get_login_max_age():
+    return getattr(settings, "CLOAK_LOGIN_MAX_AGE", MAX_AGE_OF_SIGNATURE_IN_SECONDS)
+
+
+def make_login_signature(user, single_use=False):
+    """
+    Returns the signature for a link that logs in as `user`
+    """
+    if single_use:
+        return signing.TimestampSigner(salt=LOGIN_SINGLE_USE_SALT).sign("%s:%s" % (make_nonce(), user.pk))
+    return signing.TimestampSigner().sign(str(user.pk))
+
+
+def read_login_signature(signature):
+    """
+    Returns a (pk, nonce) tuple for a login link signature, where nonce is
+    None if the link isn't single use, or (None, None) if the signature is bad
+    or expired. The caller has to check the nonce hasn't been used
+    """
+    max_age = get_login_max_age()
+    try:
+        return signing.TimestampSigner().unsign(signature, max_age=max_age), None
+    except signing.SignatureExpired:
+        return None, None
+    except signing.BadSignature:
+        # it could still be a single use link
+        pass
+
+    try:
+        nonce, pk = signing.TimestampSigner(salt=LOGIN_SINGLE_USE_SALT).unsign(signature, max_age=max_age).split(":", 1)
+    except (signing.BadSignature, ValueError):
+        return None, None
+    return pk, nonce
+
+
+def use_signed_tokens():
+    return getattr(settings, "CLOAK_SIGNED_TOKEN", False)
+
+
+def get_max_age():
+    return getattr(settings, "CLOAK_TOKEN_MAX_AGE", TOKEN_MAX_AGE)
+
+
+def get_cookie_name():
+    return getattr(settings, "CLOAK_TOKEN_COOKIE_NAME", TOKEN_COOKIE_NAME)
+
+
+def make_token(user, other_user):
+    """
+    Returns a token that lets `user` cloak as `other_user`
+    """
+    return signing.dumps([str(user.pk), str(other_user.pk)], salt=TOKEN_SALT)
+
+
+def read_token(token, user):
+    """
+    Returns the pk of the user `token` cloaks `user` as, or None if the token
+    is bad, expired, or was made for someone else
+    """
+    try:
+        actor_pk, pk = signing.loads(token, salt=TOKEN_SALT, max_age=get_max_age())
+    except (signing.BadSignature, ValueError, TypeError):
+        return None
+
+    if user.pk is None or actor_pk != str(user.pk):
+        return None
+    return pk
+
+
+def get_request_token(request):
+    """
+    Returns the token from the request's header or cookie, or None
+    """
+    return request.META.get(getattr(settings, "CLOAK_TOKEN_HEADER", TOKEN_HEADER)) or request.COOKIES.get(get_cookie_name())
+
+
+def set_token_cookie(response, token):
+    response.set_cookie(
+        get_cookie_name(),
+        token,
+        max_age=get_max_age(),
+        secure=settings.SESSION_COOKIE_SECURE or None,
+        httponly=True,
+        samesite=getattr(settings, "SESSION_COOKIE_SAMESITE", None),
+    )
+
+
+def delete_token_cookie(response):
+    response.delete_cookie(get_cookie_name())
+
+
+def get_marker_cookie_name():
+    """
+    Returns the name of the cookie that marks a cloaked session, or None if
+    the marker isn't used
+    """
+    return getattr(settings, "CLOAK_MARKER_COOKIE", None)
+
+
+def set_marker_cookie(response):
+    # the marker lives as long as the session cookie, and is sent with it
+    response.set_cookie(
+        get_marker_cookie_name(),
+        "1",
+        max_age=None if settings.SESSION_EXPIRE_AT_BROWSER_CLOSE else settings.SESSION_COOKIE_AGE,
+        domain=settings.SESSION_COOKIE_DOMAIN,
+        path=settings.SESSION_COOKIE_PATH,
+        secure=settings.SESSION_COOKIE_SECURE or None,
+        httponly=True,
+        samesite=getattr(settings, "SESSION_COOKIE_SAMESITE", None),
+    )
+
+
+def delete_marker_cookie(response):
+    response.delete_cookie(
+        get_marker_cookie_name(),
+        domain=settings.SESSION_COOKIE_DOMAIN,
+        path=settings.SESSION_COOKIE_PATH,
+    )
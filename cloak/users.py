@@ -0,0 +1,194 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import router
+from django.core.exceptions import FieldDoesNotExist
+from django.utils.module_loading import import_string
+
+from .cache import LocalUserCache, get_user_cache
+
+REPLICA_LAG = 10
+
+
+def get_user_queryset():
+    """
+    Returns the queryset cloaked users are loaded from. That's the result of
+    calling CLOAK_USER_QUERYSET (a callable, or the dotted path to one), which
+    can use select_related(), prefetch_related() or only(), or a different
+    manager. It defaults to all the users in the default manager
+    """
+    queryset = getattr(settings, "CLOAK_USER_QUERYSET", None)
+    if queryset is None:
+        return get_user_model()._default_manager.all()
+    if isinstance(queryset, str):
+        queryset = import_string(queryset)
+    return queryset()
+
+
+def get_read_database():
+    """
+    Returns CLOAK_DB_ALIAS, the database cloaked users are read from, or None
+    to leave it up to the database routers
+    """
+    return getattr(settings, "CLOAK_DB_ALIAS", None)
+
+
+def _saved_key(pk):
+    return "cloak.saved.%s" % pk
+
+
+def _get_marker_cache():
+    return caches[getattr(settings, "CLOAK_CACHE_ALIAS", None) or "default"]
+
+
+def was_recently_saved(pk):
+    """
+    Returns True if the user with this pk was saved or deleted in the last
+    CLOAK_REPLICA_LAG seconds, so the read database might not have caught up
+    """
+    return _get_marker_cache().get(_saved_key(pk)) is not None
+
+
+def mark_recently_saved(sender, instance, **kwargs):
+    """
+    Signal receiver that sends reads of `instance` to the primary database for
+    the next CLOAK_REPLICA_LAG seconds. It is connected to the post_save and
+    post_delete signals of the user model, and does nothing without
+    CLOAK_DB_ALIAS
+    """
+    if get_read_database() is None:
+        return
+
+    _get_marker_cache().set(_saved_key(instance.pk), True, timeout=getattr(settings, "CLOAK_REPLICA_LAG", REPLICA_LAG))
+
+
+def get_read_queryset(pk):
+    """
+    Returns the queryset to load the cloaked user with this pk from. With
+    CLOAK_DB_ALIAS set, that's the CLOAK_DB_ALIAS database, unless the user
+    was recently saved, in which case it's the database the user model is
+    written to
+    """
+    queryset = get_user_queryset()
+    alias = get_read_database()
+    if alias is None:
+        return queryset
+    if was_recently_saved(pk):
+        return queryset.using(router.db_for_write(queryset.model))
+    return queryset.using(alias)
+
+
+async def aget_read_queryset(pk):
+    """
+    Async version of get_read_queryset
+    """
+    if get_read_database() is None:
+        return get_user_queryset()
+    # checking the marker is a cache lookup
+    return await sync_to_async(get_read_queryset)(pk)
+
+
+def get_cloaked_user(pk, event=None):
+    """
+    Returns the user with this pk, from the user cache if it is enabled.
+    Raises User.DoesNotExist if there is no such user.
+
+    If the cache is used, "hit" or "miss" is recorded in the `event` dict
+    """
+    cache = get_user_cache()
+    version = None
+    if cache is not None:
+        # the version is read before the query, so if the user is saved while
+        # it's being loaded, the stale copy isn't stored where it'd be found
+        user, version = cache.lookup(pk)
+        if event is not None:
+            event["cache"] = "miss" if user is None else "hit"
+        if user is not None:
+            return user
+
+    user = get_read_queryset(pk).get(pk=pk)
+    if cache is not None:
+        cache.set(pk, user, version)
+    return user
+
+
+async def aget_cloaked_user(pk, event=None):
+    """
+    Async version of get_cloaked_user
+    """
+    cache = get_user_cache()
+    # the local cache never blocks, so only a shared cache is worth leaving
+    # the event loop for
+    blocking = cache is not None and not isinstance(cache, LocalUserCache)
+    version = None
+    if cache is not None:
+        user, version = await sync_to_async(cache.lookup)(pk) if blocking else cache.lookup(pk)
+        if event is not None:
+            event["cache"] = "miss" if user is None else "hit"
+        if user is not None:
+            return user
+
+    user = await aget(await aget_read_queryset(pk), pk=pk)
+    if blocking:
+        await sync_to_async(cache.set)(pk, user, version)
+    elif cache is not None:
+        cache.set(pk, user, version)
+    return user
+
+
+def aget(queryset, **kwargs):
+    """
+    QuerySet.aget() for versions of Django that don't have it
+    """
+    try:
+        return queryset.aget(**kwargs)
+    except AttributeError:
+        return sync_to_async(queryset.get)(**kwargs)
+
+
+def get_login_lookup_fields(user_model):
+    """
+    Returns the names of the fields the login command looks up identifiers
+    in, in order of priority. It's the CLOAK_LOGIN_LOOKUP_FIELDS setting, or
+    the pk, email and USERNAME_FIELD (the ones the model has)
+    """
+    fields = getattr(settings, "CLOAK_LOGIN_LOOKUP_FIELDS", None)
+    if fields is not None:
+        return list(fields)
+
+    fields = ["pk"]
+    for name in ("email", user_model.USERNAME_FIELD):
+        if name not in fields and _has_field(user_model, name):
+            fields.append(name)
+    return fields
+
+
+def get_search_fields(user_model):
+    """
+    Returns the names of the fields the search view matches the start of. It's
+    the CLOAK_SEARCH_FIELDS setting, or the USERNAME_FIELD, which is unique
+    (and so indexed)
+    """
+    fields = getattr(settings, "CLOAK_SEARCH_FIELDS", None)
+    if fields is not None:
+        return list(fields)
+    return [user_model.USERNAME_FIELD]
+
+
+def split_search_field(name):
+    """
+    Returns the (field, lookup) of a CLOAK_SEARCH_FIELDS entry, which is a
+    field name, or a field name and a lookup (like "email__istartswith").
+    Without a lookup, it's "startswith"
+    """
+    field, _, lookup = name.partition("__")
+    return field, lookup or "startswith"
+
+
+def _has_field(model, name):
+    try:
+        model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
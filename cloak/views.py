@@ -1,13 +1,96 @@
+import json
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import HttpResponseForbidden
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse
 from django.shortcuts import redirect
-from django.core.signing import TimestampSigner, BadSignature, SignatureExpired
 from django.contrib.auth import get_user_model, login as django_login, REDIRECT_FIELD_NAME
 from django.contrib.auth.decorators import login_required
-from django.views.decorators.http import require_POST
+from django.contrib.auth.views import redirect_to_login
+from django.views.decorators.http import require_GET, require_POST
 from django.shortcuts import get_object_or_404
 from django.utils.http import is_safe_url
-from . import MAX_AGE_OF_SIGNATURE_IN_SECONDS, SESSION_USER_KEY, SESSION_REDIRECT_KEY, can_cloak_as
+from . import SESSION_USER_KEY, SESSION_REDIRECT_KEY, can_cloak_as, can_cloak_as_many
+from .audit import get_audit_recorder, record
+from .instrumentation import instrument
+from .models import CloakEvent
+from .nonces import get_nonce_store
+from .ratelimit import allow_login, get_login_limiters, is_well_formed_signature
+from .registry import use_registry, register, unregister
+from .tokens import use_signed_tokens, make_token, set_token_cookie, delete_token_cookie, read_login_signature, get_login_max_age, get_marker_cookie_name, set_marker_cookie, delete_marker_cookie
+from .users import aget, aget_read_queryset, get_read_database, get_read_queryset, get_user_queryset, get_search_fields, split_search_field
+try:
+    from django.contrib.auth import alogin as django_alogin
+except ImportError:
+    django_alogin = sync_to_async(django_login)
+
+SEARCH_PAGE_SIZE = 20
+# how many pages of users the search view looks through for users the
+# requester can cloak as, before it gives up and returns a short page
+SEARCH_MAX_PAGES = 5
+
+
+def _unsign(signature):
+    """
+    Returns the pk in the signature, or None if the signature is bad, expired,
+    or is for a single use link that was already used
+    """
+    pk, nonce = read_login_signature(signature)
+    if nonce is not None and not get_nonce_store().use(nonce, get_login_max_age() + 1):
+        return None
+    return pk
+
+def _start_cloak(request, actor, user, response):
+    """
+    Cloaks `actor` as `user`, either in the session or with a signed token in
+    a cookie set on `response`
+    """
+    if use_signed_tokens():
+        set_token_cookie(response, make_token(actor, user))
+        return
+
+    request.session[SESSION_USER_KEY] = user.pk
+    if get_marker_cookie_name():
+        set_marker_cookie(response)
+    # save the referer information so when uncloaking, we can redirect the user
+    # back to where they were
+    request.session[SESSION_REDIRECT_KEY] = request.META.get("HTTP_REFERER", settings.LOGIN_REDIRECT_URL)
+    if use_registry():
+        register(request, actor, user)
+
+def _end_cloak(request):
+    """
+    Removes the cloak from the session, and returns the URL the user should be
+    redirected to
+    """
+    next = request.POST.get(REDIRECT_FIELD_NAME)
+    # with signed tokens, the view removes the cookie, and there is nothing in
+    # the session
+    if not use_signed_tokens():
+        try:
+            del request.session[SESSION_USER_KEY]
+        except KeyError:
+            pass # who cares
+        if use_registry():
+            unregister(request)
+
+        next = next or request.session.get(SESSION_REDIRECT_KEY)
+
+    # figure out where to redirect
+    if next and is_safe_url(next, request.get_host()):
+        return next
+    return settings.LOGIN_REDIRECT_URL
+
+def _uncloak_response(next):
+    response = redirect(next)
+    if use_signed_tokens():
+        delete_token_cookie(response)
+    elif get_marker_cookie_name():
+        delete_marker_cookie(response)
+    return response
 
 # no permissions necessary since this only works for valid signatures
 def login(request, signature):
@@ -15,12 +98,22 @@ def login(request, signature):
     Automatically logs in a user based on a signed PK of a user object. The
     signature should be generated with the `login` management command.
 
-    The signature will only work for 60 seconds.
+    The signature will only work for CLOAK_LOGIN_MAX_AGE seconds (60 by
+    default), and only once if it was generated for a single use link.
+    Clients that make too many requests get a 429 (see cloak.ratelimit).
     """
-    signer = TimestampSigner()
-    try:
-        pk = signer.unsign(signature, max_age=MAX_AGE_OF_SIGNATURE_IN_SECONDS)
-    except (BadSignature, SignatureExpired) as e:
+    with instrument("login", request) as event:
+        if not allow_login(request):
+            event["outcome"] = "rate-limited"
+            return HttpResponse("Too many login attempts", status=429)
+
+        if not is_well_formed_signature(signature):
+            pk = None
+            event["outcome"] = "malformed"
+        else:
+            pk = _unsign(signature)
+            event["outcome"] = "bad-signature" if pk is None else "ok"
+    if pk is None:
         return HttpResponseForbidden("Can't log you in")
 
     user = get_object_or_404(get_user_model(), pk=pk)
@@ -30,6 +123,35 @@ def login(request, signature):
 
     return redirect(settings.LOGIN_REDIRECT_URL)
 
+async def alogin(request, signature):
+    """
+    Async version of the login view
+    """
+    with instrument("login", request, count_queries=False) as event:
+        if get_login_limiters() and not await sync_to_async(allow_login)(request):
+            event["outcome"] = "rate-limited"
+            return HttpResponse("Too many login attempts", status=429)
+
+        if not is_well_formed_signature(signature):
+            pk = None
+            event["outcome"] = "malformed"
+        else:
+            pk = await sync_to_async(_unsign)(signature)
+            event["outcome"] = "bad-signature" if pk is None else "ok"
+    if pk is None:
+        return HttpResponseForbidden("Can't log you in")
+
+    User = get_user_model()
+    try:
+        user = await aget(User._default_manager.all(), pk=pk)
+    except User.DoesNotExist:
+        raise Http404("No user matches the given query.")
+    # we *have* to set the backend for this user, so we just use the first one
+    user.backend = settings.AUTHENTICATION_BACKENDS[0]
+    await django_alogin(request, user)
+
+    return redirect(settings.LOGIN_REDIRECT_URL)
+
 @login_required
 @require_POST
 def cloak(request, pk=None):
@@ -40,23 +162,64 @@ def cloak(request, pk=None):
     Callers can either pass the pk of the user in the URL itself, or as a POST
     param.
     """
-    pk = request.POST.get('pk', pk)
-    if pk is None:
-        return HttpResponse("You need to pass a pk POST parameter, or include it in the URL")
+    with instrument("cloak", request) as event:
+        pk = request.POST.get('pk', pk)
+        if pk is None:
+            event["outcome"] = "no-pk"
+            return HttpResponse("You need to pass a pk POST parameter, or include it in the URL")
 
-    user = get_object_or_404(get_user_model(), pk=pk)
+        user = get_object_or_404(get_read_queryset(pk), pk=pk)
 
-    if not can_cloak_as(request.user, user):
-        return HttpResponseForbidden("You are not allowed to cloak as this user")
+        if not can_cloak_as(request.user, user):
+            event["outcome"] = "denied"
+            return HttpResponseForbidden("You are not allowed to cloak as this user")
 
-    request.session[SESSION_USER_KEY] = user.pk
-    # save the referer information so when uncloaking, we can redirect the user
-    # back to where they were
-    request.session[SESSION_REDIRECT_KEY] = request.META.get("HTTP_REFERER", settings.LOGIN_REDIRECT_URL)
+        # redirect the cloaked user to the URL specified in the "next"
+        # parameter, or to the default redirect URL
+        response = redirect(request.POST.get(REDIRECT_FIELD_NAME, settings.LOGIN_REDIRECT_URL))
+        actor = getattr(request.user, "cloak_actor", request.user)
+        _start_cloak(request, actor, user, response)
+        record(CloakEvent.CLOAK, actor, user, request)
+        event["outcome"] = "cloaked"
+        return response
+
+async def acloak(request, pk=None):
+    """
+    Async version of the cloak view. It needs the CloakMiddleware (for
+    request.auser)
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    request_user = await request.auser()
+    if not request_user.is_authenticated:
+        return redirect_to_login(request.get_full_path())
 
-    # redirect the cloaked user to the URL specified in the "next" parameter,
-    # or to the default redirect URL
-    return redirect(request.POST.get(REDIRECT_FIELD_NAME, settings.LOGIN_REDIRECT_URL))
+    with instrument("cloak", request, count_queries=False) as event:
+        pk = request.POST.get('pk', pk)
+        if pk is None:
+            event["outcome"] = "no-pk"
+            return HttpResponse("You need to pass a pk POST parameter, or include it in the URL")
+
+        User = get_user_model()
+        try:
+            user = await aget(await aget_read_queryset(pk), pk=pk)
+        except User.DoesNotExist:
+            raise Http404("No user matches the given query.")
+
+        if not await sync_to_async(can_cloak_as)(request_user, user):
+            event["outcome"] = "denied"
+            return HttpResponseForbidden("You are not allowed to cloak as this user")
+
+        response = redirect(request.POST.get(REDIRECT_FIELD_NAME, settings.LOGIN_REDIRECT_URL))
+        actor = getattr(request_user, "cloak_actor", request_user)
+        await sync_to_async(_start_cloak)(request, actor, user, response)
+        if get_audit_recorder() is not None:
+            # recording can write to the database (or wait for room in the
+            # queue), which can't happen on the event loop
+            await sync_to_async(record)(CloakEvent.CLOAK, actor, user, request)
+        event["outcome"] = "cloaked"
+        return response
 
 # no perms neccessary here
 @require_POST
@@ -65,13 +228,124 @@ def uncloak(request):
     Undo a masquerade session and redirect the user back to where they started
     cloaking from (or where ever the "next" POST parameter points)
     """
+    with instrument("uncloak", request) as event:
+        if get_audit_recorder() is not None and getattr(request.user, "is_cloaked", False):
+            record(CloakEvent.UNCLOAK, request.user.cloak_actor, request.user, request)
+        next = _end_cloak(request)
+        event["outcome"] = "uncloaked"
+    return _uncloak_response(next)
+
+async def auncloak(request):
+    """
+    Async version of the uncloak view
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    with instrument("uncloak", request, count_queries=False) as event:
+        if get_audit_recorder() is not None:
+            user = await request.auser()
+            if getattr(user, "is_cloaked", False):
+                await sync_to_async(record)(CloakEvent.UNCLOAK, user.cloak_actor, user, request)
+        next = await sync_to_async(_end_cloak)(request)
+        event["outcome"] = "uncloaked"
+    return _uncloak_response(next)
+
+def _get_searches(queryset, q):
+    """
+    Returns a (field, queryset) pair for each of the CLOAK_SEARCH_FIELDS, with
+    the users whose field starts with `q`, and that weren't matched by the
+    fields before it. Without `q`, it's every user, by pk
+    """
+    if not q:
+        return [("pk", queryset)]
+
+    searches = []
+    matched = Q()
+    for name in get_search_fields(queryset.model):
+        field, lookup = split_search_field(name)
+        condition = Q(**{"%s__%s" % (field, lookup): q})
+        searches.append((field, queryset.filter(condition).exclude(matched)))
+        matched |= condition
+    return searches
+
+def _read_search_cursor(cursor, searches):
+    """
+    Returns the (index, after) a cursor from the search view points to: the
+    search it's in, and the (value, pk) of the last user it went through, or
+    None at the start of the search. Raises ValueError if it's invalid
+    """
     try:
-        del request.session[SESSION_USER_KEY]
-    except KeyError:
-        pass # who cares
+        index, value, pk = json.loads(cursor)
+        if not isinstance(index, int) or not 0 <= index < len(searches):
+            raise ValueError("Invalid cursor")
+        if pk is None:
+            return index, None
 
-    # figure out where to redirect
-    next = request.POST.get(REDIRECT_FIELD_NAME) or request.session.get(SESSION_REDIRECT_KEY)
-    if next and is_safe_url(next, request.get_host()):
-        return redirect(next)
-    return redirect(settings.LOGIN_REDIRECT_URL)
+        opts = searches[index][1].model._meta
+        field = opts.pk if searches[index][0] == "pk" else opts.get_field(searches[index][0])
+        return index, (field.to_python(value), opts.pk.to_python(pk))
+    except (TypeError, ValidationError) as e:
+        raise ValueError(str(e))
+
+@login_required
+@require_GET
+def search(request):
+    """
+    Returns the users whose CLOAK_SEARCH_FIELDS start with the "q" GET
+    parameter, and that request.user can cloak as, a field at a time:
+
+        {"results": [{"pk": 1, "label": "alice"}, ...], "next": "[0, \"alice\", 1]"}
+
+    The users that match a field are in order of that field (and pk), so the
+    field's index can be used to find them. To get the next page, pass "next"
+    back as the "cursor" parameter. Pages start after the cursor's field value
+    and pk (instead of using an OFFSET), so they're just as fast deep into the
+    results. "next" is null on the last page.
+    """
+    with instrument("search", request) as event:
+        queryset = get_user_queryset()
+        alias = get_read_database()
+        if alias is not None:
+            queryset = queryset.using(alias)
+        searches = _get_searches(queryset, request.GET.get("q", ""))
+
+        index, after = 0, None
+        cursor = request.GET.get("cursor") or None
+        if cursor is not None:
+            try:
+                index, after = _read_search_cursor(cursor, searches)
+            except ValueError:
+                event["outcome"] = "bad-cursor"
+                return HttpResponseBadRequest("Invalid cursor")
+
+        page_size = getattr(settings, "CLOAK_SEARCH_PAGE_SIZE", SEARCH_PAGE_SIZE)
+        results = []
+        for _ in range(SEARCH_MAX_PAGES):
+            field, matches = searches[index]
+            page = matches
+            if after is not None:
+                page = page.filter(Q(**{field + "__gt": after[0]}) | Q(**{field: after[0], "pk__gt": after[1]}))
+            users = list(page.order_by(field, "pk")[:page_size])
+            allowed = can_cloak_as_many(request.user, users)
+            for user in users:
+                after = (getattr(user, field), user.pk)
+                if user.pk in allowed:
+                    results.append({"pk": user.pk, "label": user.get_username()})
+                    if len(results) == page_size:
+                        break
+
+            # a short page means the search is over, unless the loop stopped
+            # before the end of it. Then it's on to the next field
+            if len(users) < page_size and (not users or after[1] == users[-1].pk):
+                index, after = index + 1, None
+                if index == len(searches):
+                    break
+            if len(results) == page_size:
+                break
+
+        event["outcome"] = "ok"
+        next = None
+        if index < len(searches):
+            next = json.dumps([index] + (list(after) if after is not None else [None, None]), cls=DjangoJSONEncoder)
+        return JsonResponse({"results": results, "next": next})
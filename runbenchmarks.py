@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Measures what CloakMiddleware costs per request.
+
+Each case makes the same request to a view that reads request.user, and
+reports the latency and the number of queries per request:
+
+    no-middleware   CloakMiddleware isn't installed (the baseline)
+    anonymous       an anonymous request
+    authenticated   a logged in user who isn't cloaked
+    cloaked         a logged in user cloaked as someone else
+
+Every case is run with cold caches (cleared before each request) and warm
+caches, for each of the caching configurations:
+
+    none            the default settings
+    local           CLOAK_USER_CACHE_SIZE and CLOAK_PERMISSION_CACHE_TTL
+    shared          CLOAK_CACHE_ALIAS and CLOAK_PERMISSION_CACHE_TTL
+
+Usage: ./runbenchmarks.py [--requests N] [--config none,local,shared] [--csv]
+"""
+import argparse
+import sys
+import time
+
+import django
+from django.conf import settings
+
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'cloak.middleware.CloakMiddleware',
+]
+
+settings.configure(
+    DEBUG=False,
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+        }
+    },
+    ROOT_URLCONF=__name__,
+    INSTALLED_APPS=(
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'cloak',
+    ),
+    MIDDLEWARE=MIDDLEWARE,
+    SECRET_KEY="123",
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+
+django.setup()
+
+from django.conf.urls import url
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment
+
+from cloak import SESSION_USER_KEY
+from cloak.cache import get_user_cache
+
+
+def whoami(request):
+    return HttpResponse("%s %s" % (request.user.pk, getattr(request.user, "is_cloaked", None)))
+
+urlpatterns = [
+    url(r'^whoami$', whoami),
+]
+
+CONFIGS = {
+    "none": {},
+    "local": {"CLOAK_USER_CACHE_SIZE": 1000, "CLOAK_PERMISSION_CACHE_TTL": 60},
+    "shared": {"CLOAK_CACHE_ALIAS": "default", "CLOAK_PERMISSION_CACHE_TTL": 60},
+}
+
+
+def make_client(actor=None, cloak_as=None):
+    client = Client()
+    if actor is not None:
+        client.force_login(actor)
+    if cloak_as is not None:
+        session = client.session
+        session[SESSION_USER_KEY] = cloak_as.pk
+        session.save()
+    return client
+
+
+def clear_caches():
+    cache.clear()
+    user_cache = get_user_cache()
+    if user_cache is not None:
+        user_cache.clear()
+
+
+def measure(client, requests, cold):
+    """
+    Returns a list of (seconds, queries) for each request
+    """
+    results = []
+    # one request so the warm runs really are warm
+    client.get("/whoami")
+    for i in range(requests):
+        if cold:
+            clear_caches()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = client.get("/whoami")
+            elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.status_code
+        results.append((elapsed, len(queries)))
+    return results
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the per request overhead of CloakMiddleware")
+    parser.add_argument("--requests", type=int, default=500, help="requests per case")
+    parser.add_argument("--config", default=",".join(CONFIGS), help="comma separated caching configurations to run")
+    parser.add_argument("--csv", action="store_true", help="output CSV instead of a table")
+    args = parser.parse_args(argv)
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+    User = get_user_model()
+    actor = User.objects.create(username="actor", is_staff=True)
+    target = User.objects.create(username="target")
+
+    cases = [
+        ("no-middleware", lambda: make_client(actor), MIDDLEWARE[:-1]),
+        ("anonymous", lambda: make_client(), MIDDLEWARE),
+        ("authenticated", lambda: make_client(actor), MIDDLEWARE),
+        ("cloaked", lambda: make_client(actor, target), MIDDLEWARE),
+    ]
+
+    columns = ("config", "case", "caches", "mean_us", "p50_us", "p99_us", "queries")
+    if args.csv:
+        print(",".join(columns))
+    else:
+        print("%-8s %-14s %-6s %10s %10s %10s %8s" % columns)
+
+    for config in args.config.split(","):
+        with override_settings(**CONFIGS[config]):
+            for name, client, middleware in cases:
+                for cold in (True, False):
+                    with override_settings(MIDDLEWARE=middleware):
+                        clear_caches()
+                        results = measure(client(), args.requests, cold)
+
+                    timings = [elapsed * 1e6 for elapsed, queries in results]
+                    row = (
+                        config,
+                        name,
+                        "cold" if cold else "warm",
+                        sum(timings) / len(timings),
+                        percentile(timings, 50),
+                        percentile(timings, 99),
+                        sum(queries for elapsed, queries in results) / float(len(results)),
+                    )
+                    if args.csv:
+                        print("%s,%s,%s,%.1f,%.1f,%.1f,%.2f" % row)
+                    else:
+                        print("%-8s %-14s %-6s %10.1f %10.1f %10.1f %8.2f" % row)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
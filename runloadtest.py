@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Drives simulated actors through the cloak flow, concurrently, against a local
+server, to see how cloaking behaves under load.
+
+The server is Django's threaded development server, on a SQLite database in a
+temporary directory. Each actor is a staff user, with two sessions (each with
+their own cookies), who:
+
+    login           redeems a login link (the login view), in both sessions
+    cloak           cloaks as their target user (the cloak view), in the first
+    page            requests a page that reads request.user, --pages times, in
+                    the first session
+    own             requests the page in the second session, which isn't
+                    cloaked, between each of those
+    uncloak         uncloaks (the uncloak view)
+    after           requests the page again, as themselves
+
+Every --actors-per-target actors share a target, so the cached users and
+permissions are shared between the actors cloaked as the same target, and
+the requests they make as themselves. The actors are spread over a pool of
+--processes worker processes. Every page says who request.user is, so a page
+that shows anyone but the actor's target (or the actor themselves, when not
+cloaked) is reported as a leak. The server counts the queries each request
+makes, in the X-Queries header.
+
+It reports the throughput, and the latency (p50 and p99) and queries per
+request of each step, and per flow. It exits with status 1 if there were any
+leaks or errors.
+
+Usage: ./runloadtest.py [--actors N] [--actors-per-target N] [--processes N] [--pages N] [--config none,local,shared]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+import django
+from django.conf import settings
+
+# the worker processes may import this module again, so they get the
+# directory from the environment instead of making their own
+if "CLOAK_LOADTEST_DIR" not in os.environ:
+    os.environ["CLOAK_LOADTEST_DIR"] = tempfile.mkdtemp(prefix="cloak-loadtest-")
+DATABASE_DIR = os.environ["CLOAK_LOADTEST_DIR"]
+
+settings.configure(
+    DEBUG=False,
+    ALLOWED_HOSTS=["127.0.0.1"],
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(DATABASE_DIR, "loadtest.sqlite3"),
+            # concurrent session writes wait for each other
+            'OPTIONS': {'timeout': 60},
+        }
+    },
+    ROOT_URLCONF=__name__,
+    INSTALLED_APPS=(
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'cloak',
+    ),
+    MIDDLEWARE=[
+        __name__ + '.QueryCountMiddleware',
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'cloak.middleware.CloakMiddleware',
+    ],
+    SECRET_KEY="123",
+    LOGIN_REDIRECT_URL="/whoami",
+    CLOAK_LOGIN_MAX_AGE=60 * 60,
+)
+
+django.setup()
+
+from django.conf.urls import include, url
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection
+from django.http import HttpResponse
+from django.test.utils import override_settings
+
+from cloak.tokens import make_login_signature
+
+
+def whoami(request):
+    return HttpResponse("%s %s" % (request.user.pk, getattr(request.user, "is_cloaked", None)))
+
+urlpatterns = [
+    url(r'^cloak/', include('cloak.urls')),
+    url(r'^whoami$', whoami),
+]
+
+CONFIGS = {
+    "none": {},
+    "local": {"CLOAK_USER_CACHE_SIZE": 1000, "CLOAK_PERMISSION_CACHE_TTL": 60},
+    "shared": {"CLOAK_CACHE_ALIAS": "default", "CLOAK_PERMISSION_CACHE_TTL": 60},
+}
+
+STEPS = ("login", "cloak", "page", "own", "uncloak", "after")
+
+
+class QueryCountMiddleware(object):
+    """
+    Puts the number of queries the request made in the X-Queries header
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        response["X-Queries"] = str(len(queries))
+        return response
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class NoRedirectHandler(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def start_server():
+    """
+    Starts the server in a thread, and returns its address
+    """
+    server = ThreadedWSGIServer(("127.0.0.1", 0), QuietRequestHandler, allow_reuse_address=False)
+    server.set_app(WSGIHandler())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+
+def fetch(opener, address, path, post=False):
+    """
+    Returns the (status, body, seconds, queries) of a request
+    """
+    start = time.perf_counter()
+    try:
+        response = opener.open(address + path, data=b"" if post else None)
+    except HTTPError as e:
+        # including the redirects, which aren't followed
+        response = e
+    body = response.read().decode()
+    elapsed = time.perf_counter() - start
+    return response.getcode(), body, elapsed, int(response.headers.get("X-Queries", 0))
+
+
+def run_actor(args):
+    """
+    Takes an actor through the flow. Returns a list of (step, seconds,
+    queries), and a list of problems
+    """
+    address, actor_pk, target_pk, signature, pages = args
+    opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirectHandler())
+    own_opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirectHandler())
+    results = []
+    problems = []
+
+    def step(name, path, expected_status, expected_body=None, post=False, opener=opener):
+        status, body, elapsed, queries = fetch(opener, address, path, post)
+        results.append((name, elapsed, queries))
+        if status != expected_status:
+            problems.append("actor %s: %s returned %s" % (actor_pk, name, status))
+        elif expected_body is not None and body != expected_body:
+            problems.append("actor %s: %s was for %r, expected %r" % (actor_pk, name, body, expected_body))
+
+    step("login", "/cloak/login/%s" % signature, 302)
+    step("login", "/cloak/login/%s" % signature, 302, opener=own_opener)
+    step("cloak", "/cloak/cloak/%s" % target_pk, 302, post=True)
+    for i in range(pages):
+        step("page", "/whoami", 200, "%s True" % target_pk)
+        step("own", "/whoami", 200, "%s False" % actor_pk, opener=own_opener)
+    step("uncloak", "/cloak/uncloak", 302, post=True)
+    step("after", "/whoami", 200, "%s False" % actor_pk)
+    return results, problems
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report(config, results, elapsed, actors):
+    requests = sum(len(flow) for flow in results)
+    print("%s: %d flows, %d requests in %.1fs, %.1f requests/s, %.1f flows/s" % (config, actors, requests, elapsed, requests / elapsed, actors / elapsed))
+    print("%-8s %9s %10s %10s %8s" % ("step", "requests", "p50_ms", "p99_ms", "queries"))
+
+    rows = [(name, [(seconds, queries) for flow in results for step, seconds, queries in flow if step == name]) for name in STEPS]
+    rows.append(("flow", [(sum(seconds for step, seconds, queries in flow), sum(queries for step, seconds, queries in flow)) for flow in results]))
+    for name, values in rows:
+        timings = [seconds * 1e3 for seconds, queries in values]
+        print("%-8s %9d %10.1f %10.1f %8.2f" % (
+            name,
+            len(values),
+            percentile(timings, 50),
+            percentile(timings, 99),
+            sum(queries for seconds, queries in values) / float(len(values)),
+        ))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load test the cloak flow with concurrent actors")
+    parser.add_argument("--actors", type=int, default=1000, help="number of simulated actors")
+    parser.add_argument("--actors-per-target", type=int, default=4, help="number of actors that cloak as each target")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="number of worker processes")
+    parser.add_argument("--pages", type=int, default=5, help="pages each actor requests while cloaked")
+    parser.add_argument("--config", default="none", help="comma separated caching configurations to run (%s)" % ", ".join(CONFIGS))
+    args = parser.parse_args(argv)
+
+    try:
+        call_command("migrate", verbosity=0)
+        User = get_user_model()
+        User.objects.bulk_create([User(username="actor%d" % i, is_staff=True) for i in range(args.actors)])
+        targets = (args.actors + args.actors_per_target - 1) // args.actors_per_target
+        User.objects.bulk_create([User(username="target%d" % i) for i in range(targets)])
+        # bulk_create doesn't set the pks on SQLite (with older versions of
+        # Django), so load them again
+        actors = list(User.objects.filter(username__startswith="actor").order_by("pk"))
+        targets = list(User.objects.filter(username__startswith="target").order_by("pk"))
+
+        failed = False
+        for config in args.config.split(","):
+            with override_settings(**CONFIGS[config]):
+                server, address = start_server()
+                jobs = [
+                    (address, actor.pk, targets[i // args.actors_per_target].pk, make_login_signature(actor), args.pages)
+                    for i, actor in enumerate(actors)
+                ]
+                start = time.perf_counter()
+                with multiprocessing.Pool(args.processes) as pool:
+                    flows = pool.map(run_actor, jobs, chunksize=max(1, len(jobs) // (args.processes * 4)))
+                elapsed = time.perf_counter() - start
+                server.shutdown()
+                server.server_close()
+
+            report(config, [results for results, problems in flows], elapsed, len(jobs))
+            problems = [problem for results, flow_problems in flows for problem in flow_problems]
+            if problems:
+                failed = True
+                print("%d problems, including:" % len(problems))
+                for problem in problems[:10]:
+                    print("    %s" % problem)
+            else:
+                print("no leaks or errors")
+            print("")
+    finally:
+        shutil.rmtree(DATABASE_DIR, ignore_errors=True)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -9,12 +9,19 @@ setup(
     author='Matt Johnson',
     author_email='mdj2@pdx.edu',
     description="App for Django to cloak as a user, or generate a login link",
-    packages=['cloak','cloak.management', 'cloak.management.commands'],
+    packages=['cloak', 'cloak.management', 'cloak.management.commands', 'cloak.migrations', 'cloak.templatetags'],
+    include_package_data=True,
+    package_data={'cloak': ['templates/cloak/*.html']},
     zip_safe=False,
     classifiers=[
         'Framework :: Django',
+        'Framework :: Django :: 3.1',
+        'Framework :: Django :: 3.2',
+        'Programming Language :: Python :: 3',
     ],
+    python_requires='>=3.6',
+    install_requires=['Django>=3.1,<4.0', 'asgiref>=3.2'],
     extras_require={
-        'test': ['model_mommy', 'mock', 'django'],
+        'test': ['model_mommy', 'mock'],
     }
 )